@@ -1,8 +1,27 @@
+import hashlib
+import json
 import os
 import tempfile
+import threading
+import time
+import isodate
 import pytest
-from evernote.edam.error.ttypes import EDAMUserException
-from tomboy2evernote.tomboy2evernote import Evernote, convert_tomboy_to_evernote
+import lxml.etree as xml
+from evernote.edam.error.ttypes import EDAMUserException, EDAMNotFoundException, EDAMSystemException, EDAMErrorCode
+from evernote.edam.notestore.ttypes import NotesMetadataList, NoteMetadata, SyncChunk, SyncState
+from evernote.edam.type.ttypes import Note, Notebook
+from thrift.transport.TTransport import TTransportException
+from tomboy2evernote.dates import parse_tomboy_date, tomboy_timestamp
+from tomboy2evernote.daemon import Debouncer, KeyedWorkQueue, DaemonState, NoteState, NotesDaemon, LIVE_PRIORITY, \
+    BACKLOG_PRIORITY
+from tomboy2evernote.index import NoteIndex
+from tomboy2evernote.manifest import SyncManifest
+from tomboy2evernote.throttle import RateLimiter, RetryPolicy, CircuitBreaker, ConcurrencyController
+from tomboy2evernote.mirror import RemoteMirror
+from tomboy2evernote.pipeline import Stage, batches, run_pipeline
+from tomboy2evernote.tomboy2evernote import ENGINES, Evernote, NoteHeader, NoteSelector, TomboyConverter, \
+    convert_tomboy_to_evernote, convert_notes, new_process_pool
+from tomboy2evernote.watchers import PollingWatcher
 
 __author__ = 'Denis Kovalev (aikikode)'
 
@@ -11,6 +30,120 @@ TOMBOY_HEADER = ("<?xml version=\"1.0\" encoding=\"utf-8\"?>\n"
                  "xmlns:size=\"http://beatniksoftware.com/tomboy/size\" xmlns=\"http://beatniksoftware.com/tomboy\">")
 
 
+class FakeNoteStore(object):
+    """ In-memory NoteStore replacement that records every API call """
+    def __init__(self):
+        self.notes = {}
+        self.notebooks = {}
+        self.calls = []
+        self.usn = 0
+        self.expunged = {}  # note guid -> USN of expunge
+        self.full_sync_before = 0
+
+    def _next_usn(self):
+        self.usn += 1
+        return self.usn
+
+    @staticmethod
+    def _set_content(note, old_note=None):
+        if note.content is None and old_note is not None:
+            note.content = old_note.content
+        if note.content is not None:
+            content = note.content.encode('utf-8')
+            note.contentHash, note.contentLength = hashlib.md5(content).digest(), len(content)
+
+    def findNotesMetadata(self, note_filter, offset, max_notes, result_spec):
+        self.calls.append('findNotesMetadata')
+        assert result_spec.includeTitle
+        words = note_filter.words.replace('intitle:', '').strip('"')
+        found = [n for n in self.notes.values() if words in n.title and n.active is not False]
+        return NotesMetadataList(startIndex=offset, totalNotes=len(found), notes=[
+            NoteMetadata(guid=n.guid, title=n.title, updateSequenceNum=n.updateSequenceNum)
+            for n in found[offset:offset + max_notes]
+        ])
+
+    def getNote(self, guid, with_content, *args):
+        self.calls.append('getNote')
+        if guid not in self.notes:
+            raise EDAMNotFoundException()
+        return self.notes[guid]
+
+    def createNote(self, note):
+        self.calls.append('createNote')
+        self._set_content(note)
+        note.active = True
+        note.updateSequenceNum = self._next_usn()
+        note.guid = 'ev-{}'.format(note.updateSequenceNum)
+        self.notes[note.guid] = note
+        return note
+
+    def updateNote(self, note):
+        self.calls.append('updateNote')
+        if note.guid not in self.notes:
+            raise EDAMNotFoundException()
+        self._set_content(note, self.notes[note.guid])
+        if note.active is None:
+            note.active = self.notes[note.guid].active
+        note.updateSequenceNum = self._next_usn()
+        self.notes[note.guid] = note
+        return note
+
+    def deleteNote(self, guid):
+        self.calls.append('deleteNote')
+        if guid not in self.notes:
+            raise EDAMNotFoundException()
+        del self.notes[guid]
+        self.expunged[guid] = self._next_usn()
+
+    def getSyncState(self):
+        self.calls.append('getSyncState')
+        return SyncState(currentTime=1, fullSyncBefore=self.full_sync_before, updateCount=self.usn)
+
+    def getFilteredSyncChunk(self, after_usn, max_entries, sync_filter):
+        self.calls.append('getFilteredSyncChunk')
+        entries = sorted(
+            [(n.updateSequenceNum, 'note', n) for n in self.notes.values()] +
+            [(n.updateSequenceNum, 'notebook', n) for n in self.notebooks.values()] +
+            [(usn, 'expunged', guid) for guid, usn in self.expunged.items()],
+            key=lambda e: e[0]
+        )
+        entries = [e for e in entries if e[0] > after_usn][:max_entries]
+        return SyncChunk(
+            chunkHighUSN=entries[-1][0] if entries else None, updateCount=self.usn,
+            notes=[Note(guid=e[2].guid, title=e[2].title, updateSequenceNum=e[0], active=e[2].active,
+                        contentHash=e[2].contentHash, contentLength=e[2].contentLength,
+                        created=e[2].created, updated=e[2].updated) for e in entries if e[1] == 'note'],
+            notebooks=[e[2] for e in entries if e[1] == 'notebook'],
+            expungedNotes=[e[2] for e in entries if e[1] == 'expunged'],
+        )
+
+    def listNotebooks(self):
+        self.calls.append('listNotebooks')
+        return list(self.notebooks.values())
+
+    def createNotebook(self, notebook):
+        self.calls.append('createNotebook')
+        notebook.updateSequenceNum = self._next_usn()
+        notebook.guid = 'nb-{}'.format(notebook.updateSequenceNum)
+        self.notebooks[notebook.guid] = notebook
+        return notebook
+
+
+def make_note(title, **kwargs):
+    note = {'title': title, 'content': '<en-note>{}</en-note>'.format(title), 'notebook': None,
+            'created': 1000, 'updated': 2000}
+    note.update(kwargs)
+    return note
+
+
+def wait_for(condition, timeout=5):
+    """ Wait until the condition set by other threads is true, return its final value """
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
 class TestEvernote(object):
     def test_init_no_params(self):
         with pytest.raises(TypeError):
@@ -21,6 +154,946 @@ class TestEvernote(object):
             Evernote("wrong_token")
 
 
+class TestFindNote(object):
+    def fill_store(self, titles):
+        store = FakeNoteStore()
+        for title in titles:
+            store.createNote(Note(title=title, content='<en-note>{}</en-note>'.format(title)))
+        del store.calls[:]
+        return store
+
+    def test_find_note_pagination(self):
+        store = self.fill_store(['Hello {}'.format(i) for i in range(7)] + ['Hello'])
+        client = Evernote('token', note_store=store, search_page_size=3)
+        note = client.find_note('Hello')
+        assert note.title == 'Hello'
+        assert store.calls == ['findNotesMetadata'] * 3
+
+    def test_find_note_not_found(self):
+        store = self.fill_store(['Hello {}'.format(i) for i in range(7)])
+        client = Evernote('token', note_store=store, search_page_size=3)
+        assert client.find_note('Hello') is None
+        assert store.calls == ['findNotesMetadata'] * 3
+
+    def test_find_note_with_content(self):
+        store = self.fill_store(['Hello world', 'Hello'])
+        client = Evernote('token', note_store=store)
+        assert isinstance(client.find_note('Hello'), NoteMetadata)
+        assert 'getNote' not in store.calls
+        note = client.find_note('Hello', with_content=True)
+        assert note.content == '<en-note>Hello</en-note>'
+        assert store.calls[-1] == 'getNote'
+
+
+class TestRemoteMirror(object):
+    def test_prefetch(self, monkeypatch):
+        monkeypatch.setattr('tomboy2evernote.tomboy2evernote.SYNC_CHUNK_SIZE', 2)
+        store = FakeNoteStore()
+        for title in ['One', 'Two', 'Three', 'Four', 'Five']:
+            store.createNote(Note(title=title))
+        store.deleteNote('ev-2')
+        client = Evernote('token', note_store=store)
+        client.prefetch()
+        assert store.calls.count('getFilteredSyncChunk') == 3
+        assert sorted(n.title for n in client.mirror.notes.values()) == ['Five', 'Four', 'One', 'Three']
+        assert client.mirror.update_count == store.usn
+
+    def test_no_search_after_prefetch(self):
+        store = FakeNoteStore()
+        store.createNote(Note(title='Hello'))
+        client = Evernote('token', note_store=store)
+        client.prefetch()
+        del store.calls[:]
+        client.create_or_update_note(make_note('Hello'))
+        client.create_or_update_note(make_note('World'))
+        assert 'findNotesMetadata' not in store.calls
+        assert sorted(n.title for n in store.notes.values()) == ['Hello', 'World']
+        assert client.mirror.find('World').guid in store.notes
+
+    def test_incremental_sync(self, tmpdir):
+        mirror_path = str(tmpdir.join('mirror.json'))
+        store = FakeNoteStore()
+        for title in ['One', 'Two', 'Three']:
+            store.createNote(Note(title=title, content=title))
+        client = Evernote('token', note_store=store)
+        client.prefetch(RemoteMirror.load(mirror_path))
+        assert os.path.exists(mirror_path)
+
+        store.deleteNote('ev-1')
+        store.createNote(Note(title='Four'))
+        del store.calls[:]
+        client = Evernote('token', note_store=store)
+        client.prefetch(RemoteMirror.load(mirror_path))
+        assert store.calls == ['getSyncState', 'getFilteredSyncChunk']
+        assert sorted(n.title for n in client.mirror.notes.values()) == ['Four', 'Three', 'Two']
+        assert client.mirror.find('Two').contentHash == hashlib.md5(b'Two').digest()
+
+        del store.calls[:]
+        client.sync_mirror()
+        assert store.calls == ['getSyncState']
+
+    def test_note_deleted_remotely(self, tmpdir):
+        store = FakeNoteStore()
+        index = NoteIndex(str(tmpdir.join('index.sqlite')))
+        client = Evernote('token', index=index, note_store=store)
+        client.prefetch()
+        client.create_or_update_note(make_note('Hello', guid='a'))
+        store.deleteNote(index.lookup(tomboy_guid='a').evernote_guid)
+        client.sync_mirror()
+        del store.calls[:]
+        client.create_or_update_note(make_note('Hello', guid='a'))
+        assert store.calls == ['createNote']
+        assert index.lookup(tomboy_guid='a').evernote_guid in store.notes
+        index.close()
+
+    def test_concurrent_sync(self):
+        store = FakeNoteStore()
+        store.createNote(Note(title='Hello'))
+        client = Evernote('token', note_store=store)
+        client.prefetch()
+        client.mirror_synced = 0
+        del store.calls[:]
+        get_sync_state = store.getSyncState
+        store.getSyncState = lambda: (time.sleep(0.1), get_sync_state())[1]
+        threads = [threading.Thread(target=client.sync_mirror, kwargs={'max_age': 60}) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert store.calls == ['getSyncState']
+
+    def test_full_sync_keeps_old_mirror(self):
+        store = FakeNoteStore()
+        store.createNote(Note(title='Hello'))
+        client = Evernote('token', note_store=store)
+        client.prefetch()
+        old_mirror = client.mirror
+        store.createNote(Note(title='World'))
+        store.full_sync_before = 2
+        seen = []
+        get_chunk = store.getFilteredSyncChunk
+
+        def get_filtered_sync_chunk(*args):
+            # Other threads still find notes while the new mirror is being built
+            seen.append(client.mirror.find('Hello') is not None)
+            return get_chunk(*args)
+
+        store.getFilteredSyncChunk = get_filtered_sync_chunk
+        client.sync_mirror()
+        assert seen == [True]
+        assert client.mirror is not old_mirror
+        assert sorted(n.title for n in client.mirror.notes.values()) == ['Hello', 'World']
+
+
+class TestSkipUnchanged(object):
+    def test_skip_unchanged(self):
+        store = FakeNoteStore()
+        client = Evernote('token', note_store=store)
+        client.prefetch()
+        client.create_or_update_note(make_note('Hello'))
+        client.sync_mirror()
+        del store.calls[:]
+        client.create_or_update_note(make_note('Hello'))
+        assert store.calls == []
+        assert client.stats['skipped'] == 1
+
+    def test_metadata_only_update(self):
+        store = FakeNoteStore()
+        client = Evernote('token', note_store=store)
+        client.prefetch()
+        client.create_or_update_note(make_note('Hello'))
+        client.create_or_update_note(make_note('Hello', updated=3000))
+        assert client.stats['metadata_updated'] == 1
+        note = list(store.notes.values())[0]
+        assert note.updated == 3000
+        assert note.content == '<en-note>Hello</en-note>'
+
+    def test_changed_content_uploaded(self):
+        store = FakeNoteStore()
+        client = Evernote('token', note_store=store)
+        client.prefetch()
+        client.create_or_update_note(make_note('Hello'))
+        client.create_or_update_note(make_note('Hello', content='<en-note>World</en-note>'))
+        assert client.stats['updated'] == 1
+        assert list(store.notes.values())[0].content == '<en-note>World</en-note>'
+
+
+class TestNotebooks(object):
+    def test_notebooks_cache(self):
+        store = FakeNoteStore()
+        store.createNotebook(Notebook(name='Work'))
+        client = Evernote('token', note_store=store)
+        client.create_or_update_note(make_note('One', notebook='Work'))
+        client.create_or_update_note(make_note('Two', notebook='Home'))
+        client.create_or_update_note(make_note('Three', notebook='Home'))
+        assert store.calls.count('listNotebooks') == 1
+        assert store.calls.count('createNotebook') == 2
+        assert [n.notebookGuid for n in store.notes.values()] == ['nb-1', 'nb-3', 'nb-3']
+
+    def test_stats_during_notebook_creation(self):
+        store = FakeNoteStore()
+        client = Evernote('token', note_store=store)
+        creating, created = threading.Event(), threading.Event()
+        create_notebook = store.createNotebook
+
+        def slow_create_notebook(notebook):
+            creating.set()
+            created.wait(5)
+            return create_notebook(notebook)
+
+        store.createNotebook = slow_create_notebook
+        thread = threading.Thread(target=client.get_notebook_guid, args=('Work', ))
+        thread.start()
+        assert creating.wait(5)
+        # Upload threads must not wait for the notebook to count their notes
+        counter = threading.Thread(target=client.count, args=('created', ))
+        counter.start()
+        counter.join(1)
+        assert not counter.is_alive()
+        created.set()
+        thread.join()
+        assert client.stats['created'] == 1
+        assert [n.name for n in store.notebooks.values()] == ['Work']
+
+    def test_notebooks_from_mirror(self):
+        store = FakeNoteStore()
+        store.createNotebook(Notebook(name='Work'))
+        client = Evernote('token', note_store=store)
+        client.prefetch()
+        del store.calls[:]
+        client.create_or_update_note(make_note('One', notebook='Work'))
+        assert store.calls == ['createNote']
+
+
+class TestNoteIndex(object):
+    @pytest.fixture
+    def index(self, request):
+        _, tmp = tempfile.mkstemp()
+        index = NoteIndex(tmp)
+
+        def fin():
+            index.close()
+            os.remove(tmp)
+
+        request.addfinalizer(fin)
+        return index
+
+    def test_update_uses_index(self, index):
+        store = FakeNoteStore()
+        client = Evernote('token', index=index, note_store=store)
+        client.create_or_update_note(make_note('Hello', path='/tmp/a.note', guid='a'))
+        assert store.calls == ['findNotesMetadata', 'createNote']
+        del store.calls[:]
+        client.create_or_update_note(make_note('Hello', path='/tmp/a.note', guid='a'))
+        assert store.calls == ['updateNote']
+
+    def test_renamed_note_found_by_tomboy_guid(self, index):
+        store = FakeNoteStore()
+        client = Evernote('token', index=index, note_store=store)
+        client.create_or_update_note(make_note('Hello', guid='a'))
+        client.create_or_update_note(make_note('Bye', guid='a'))
+        assert [n.title for n in store.notes.values()] == ['Bye']
+        assert index.lookup(title='Hello') is None
+        assert index.lookup(tomboy_guid='a').title == 'Bye'
+
+    def test_note_expunged_remotely(self, index):
+        store = FakeNoteStore()
+        client = Evernote('token', index=index, note_store=store)
+        client.create_or_update_note(make_note('Hello', guid='a'))
+        store.notes.clear()
+        client.create_or_update_note(make_note('Hello', guid='a'))
+        assert len(store.notes) == 1
+        assert index.lookup(tomboy_guid='a').evernote_guid in store.notes
+
+    def test_note_moved_to_trash(self, index):
+        store = FakeNoteStore()
+        client = Evernote('token', index=index, note_store=store)
+        trashed = client.create_or_update_note(make_note('Hello', guid='a')).guid
+        store.notes[trashed].active = False
+        del store.calls[:]
+        note = client.create_or_update_note(make_note('Hello', guid='a'))
+        assert store.calls == ['updateNote', 'findNotesMetadata', 'createNote']
+        assert note.guid != trashed and note.active
+        assert store.notes[trashed].active is False
+        assert index.lookup(tomboy_guid='a').evernote_guid == note.guid
+
+    def test_remove_note(self, index):
+        store = FakeNoteStore()
+        client = Evernote('token', index=index, note_store=store)
+        client.create_or_update_note(make_note('Hello', guid='a'))
+        del store.calls[:]
+        client.remove_note('Hello')
+        assert store.calls == ['deleteNote']
+        assert not store.notes
+        assert index.lookup(title='Hello') is None
+
+
+class TestConcurrentUpload(object):
+    def test_rate_limiter(self):
+        limiter = RateLimiter(rate=100, capacity=1)
+        start = time.monotonic()
+        for _ in range(6):
+            limiter.acquire()
+        assert time.monotonic() - start >= 0.04
+
+    def test_rate_limiter_pause(self):
+        limiter = RateLimiter()
+        limiter.pause(0.05)
+        start = time.monotonic()
+        limiter.acquire()
+        assert time.monotonic() - start >= 0.04
+
+    def test_note_store_per_thread(self, monkeypatch):
+        monkeypatch.setattr(Evernote, 'get_note_store', lambda self: object())
+        client = Evernote('token')
+        stores = []
+        thread = threading.Thread(target=lambda: stores.extend([client.note_store, client.note_store]))
+        thread.start()
+        thread.join()
+        assert stores[0] is stores[1]
+        assert stores[0] is not client.note_store
+
+    def test_rate_limit_pauses_all_callers(self, monkeypatch):
+        monkeypatch.setattr('tomboy2evernote.throttle.RATE_LIMIT_MARGIN', 0)
+        client = Evernote('token', note_store=FakeNoteStore())
+        attempts = []
+
+        def limited_call():
+            attempts.append(time.monotonic())
+            if len(attempts) == 1:
+                raise EDAMSystemException(errorCode=EDAMErrorCode.RATE_LIMIT_REACHED, rateLimitDuration=0.1)
+            return 'done'
+
+        assert client.call_method(limited_call) == 'done'
+        assert attempts[1] - attempts[0] >= 0.09
+        assert client.rate_limiter.paused_until > 0
+
+
+class TestRetryPolicy(object):
+    def failing_call(self, errors):
+        errors = list(errors)
+
+        def call():
+            if errors:
+                raise errors.pop(0)
+            return 'done'
+        return call
+
+    def test_transient_errors_retried(self):
+        client = Evernote('token', note_store=FakeNoteStore(), retry_policy=RetryPolicy(backoff=0.001))
+        call = self.failing_call([ConnectionResetError(), EDAMSystemException(errorCode=EDAMErrorCode.INTERNAL_ERROR)])
+        assert client.call_method(call) == 'done'
+
+    def test_fatal_errors_not_retried(self):
+        client = Evernote('token', note_store=FakeNoteStore(), retry_policy=RetryPolicy(backoff=0.001))
+        call = self.failing_call([EDAMUserException(errorCode=EDAMErrorCode.BAD_DATA_FORMAT)])
+        with pytest.raises(EDAMUserException):
+            client.call_method(call)
+        assert call() == 'done'
+
+    def test_attempts_exhausted(self):
+        client = Evernote('token', note_store=FakeNoteStore(), retry_policy=RetryPolicy(attempts=3, backoff=0.001))
+        with pytest.raises(ConnectionResetError):
+            client.call_method(self.failing_call([ConnectionResetError()] * 3))
+
+    def test_non_idempotent_calls(self, monkeypatch):
+        monkeypatch.setattr('tomboy2evernote.throttle.RATE_LIMIT_MARGIN', 0)
+        client = Evernote('token', note_store=FakeNoteStore(), retry_policy=RetryPolicy(backoff=0.001))
+        # The service may have applied the call before the connection broke
+        call = self.failing_call([ConnectionResetError()])
+        with pytest.raises(ConnectionResetError):
+            client.call_method(call, idempotent=False)
+        assert call() == 'done'
+        # The request was never sent or the service refused it
+        call = self.failing_call([ConnectionRefusedError(), TTransportException(TTransportException.NOT_OPEN),
+                                  EDAMSystemException(errorCode=EDAMErrorCode.RATE_LIMIT_REACHED, rateLimitDuration=0)])
+        assert client.call_method(call, idempotent=False) == 'done'
+
+    def test_create_note_connection_reset(self):
+        store = FakeNoteStore()
+        client = Evernote('token', note_store=store, retry_policy=RetryPolicy(backoff=0.001))
+        create_note = store.createNote
+
+        def create_note_and_fail(note):
+            if note.title == 'Hello':
+                create_note(note)
+            else:
+                store.calls.append('createNote')
+            raise ConnectionResetError()
+
+        store.createNote = create_note_and_fail
+        note = client.create_or_update_note(make_note('Hello'))
+        assert store.calls == ['findNotesMetadata', 'createNote', 'findNotesMetadata']
+        assert [n.guid for n in store.notes.values()] == [note.guid]
+        assert client.stats['created'] == 1
+        # Nothing was created: the error is reported instead of creating the note again
+        del store.calls[:]
+        with pytest.raises(ConnectionResetError):
+            client.create_or_update_note(make_note('World'))
+        assert store.calls == ['findNotesMetadata', 'createNote', 'findNotesMetadata']
+
+    def test_create_notebook_connection_reset(self):
+        store = FakeNoteStore()
+        client = Evernote('token', note_store=store, retry_policy=RetryPolicy(backoff=0.001))
+        create_notebook = store.createNotebook
+
+        def create_notebook_and_fail(notebook):
+            create_notebook(notebook)
+            raise ConnectionResetError()
+
+        store.createNotebook = create_notebook_and_fail
+        guid = client.get_notebook_guid('Work')
+        assert store.calls == ['listNotebooks', 'createNotebook', 'listNotebooks']
+        assert [n.guid for n in store.notebooks.values()] == [guid]
+
+    def test_backoff(self):
+        policy = RetryPolicy(attempts=10, backoff=1, max_backoff=10, jitter=0.5)
+        error = ConnectionResetError()
+        assert 0.5 <= policy.retry_delay(error, 0) <= 1.5
+        assert 2 <= policy.retry_delay(error, 2) <= 6
+        assert 5 <= policy.retry_delay(error, 5) <= 15
+        assert policy.retry_delay(error, 9) is None
+        assert policy.retry_delay(EDAMNotFoundException(), 0) is None
+
+    def test_circuit_breaker(self):
+        limiter = RateLimiter()
+        breaker = CircuitBreaker(limiter, failure_threshold=3, break_duration=10)
+        breaker.failure()
+        breaker.failure()
+        breaker.success()
+        breaker.failure()
+        breaker.failure()
+        assert limiter.paused_until == 0
+        breaker.failure()
+        assert limiter.paused_until > time.monotonic() + 9
+
+
+class TestConcurrencyController(object):
+    def test_additive_increase(self):
+        controller = ConcurrencyController(initial=2, maximum=4, target_latency=1)
+        for _ in range(20):
+            controller.acquire()
+            controller.release(0.1)
+        assert controller.limit == 4
+        assert [limit for _, limit in controller.history] == [2, 3, 4]
+
+    def test_slow_or_failed_requests_hold(self):
+        controller = ConcurrencyController(initial=2, target_latency=1)
+        for latency in [5, None, 5, None]:
+            controller.acquire()
+            controller.release(latency)
+        assert controller.limit == 2
+
+    def test_multiplicative_decrease(self):
+        controller = ConcurrencyController(initial=8, cooldown=0)
+        controller.backoff()
+        assert controller.limit == 4
+        controller.backoff()
+        controller.backoff()
+        controller.backoff()
+        assert controller.limit == 1
+        controller.cooldown = 60
+        controller.limit = 8
+        controller.backoff()
+        assert controller.limit == 8
+
+    def test_limit_in_flight(self):
+        controller = ConcurrencyController(initial=1)
+        controller.acquire()
+        acquired = threading.Event()
+        thread = threading.Thread(target=lambda: (controller.acquire(), acquired.set()))
+        thread.start()
+        assert not acquired.wait(0.05)
+        controller.release()
+        assert acquired.wait(1)
+        thread.join()
+
+    def test_rate_limit_reported(self, monkeypatch):
+        monkeypatch.setattr('tomboy2evernote.throttle.RATE_LIMIT_MARGIN', 0)
+        controller = ConcurrencyController(initial=4)
+        client = Evernote('token', note_store=FakeNoteStore(), concurrency=controller)
+        errors = [EDAMSystemException(errorCode=EDAMErrorCode.RATE_LIMIT_REACHED, rateLimitDuration=0)]
+
+        def call():
+            if errors:
+                raise errors.pop()
+
+        client.call_method(call)
+        assert controller.limit == 2
+
+
+class TestPipeline(object):
+    def test_all_items_pass_all_stages(self):
+        results = run_pipeline(range(100), [Stage(lambda i: i * 2, 3), Stage(lambda i: i if i % 4 else None, 2)])
+        assert sorted(results) == [i * 2 for i in range(100) if i % 2]
+
+    def test_streaming(self):
+        produced = []
+
+        def source():
+            for i in range(1000):
+                produced.append(i)
+                yield i
+
+        results = run_pipeline(source(), [Stage(lambda i: i, 1)], queue_size=2)
+        assert next(results) == 0
+        assert len(produced) < 10
+
+    def test_failed_item_dropped(self):
+        assert sorted(run_pipeline(range(5), [Stage(lambda i: 10 // (i - 2), 2)])) == [-10, -5, 5, 10]
+
+    def test_batches(self):
+        assert list(batches(range(7), 3)) == [[0, 1, 2], [3, 4, 5], [6]]
+        assert list(batches([], 3)) == []
+
+
+class TestDebouncer(object):
+    def test_burst_coalesced(self):
+        debouncer = Debouncer(quiet_period=2)
+        for now in [0, 0.1, 1, 1.5]:
+            debouncer.touch('a.note', now=now)
+        debouncer.touch('b.note', now=0.5)
+        assert debouncer.pop_due(now=2) == []
+        assert debouncer.pop_due(now=3) == ['b.note']
+        assert debouncer.pop_due(now=3.5) == ['a.note']
+        assert debouncer.pop_due(now=10) == []
+
+    def test_max_delay(self):
+        debouncer = Debouncer(quiet_period=2, max_delay=5)
+        for now in range(5):
+            debouncer.touch('a.note', now=now)
+            assert debouncer.pop_due(now=now) == []
+        debouncer.touch('a.note', now=5)
+        assert debouncer.pop_due(now=5) == ['a.note']
+
+    def test_discard(self):
+        debouncer = Debouncer(quiet_period=2)
+        debouncer.touch('a.note', now=0)
+        debouncer.discard('a.note')
+        debouncer.discard('b.note')
+        assert debouncer.pop_due(now=10) == []
+
+
+class TestKeyedWorkQueue(object):
+    def test_latest_wins(self):
+        work_queue = KeyedWorkQueue()
+        work_queue.put('a.note', 1)
+        work_queue.put('b.note', 1)
+        work_queue.put('a.note', 2)
+        assert len(work_queue) == 2
+        assert work_queue.get() == ('a.note', 2)
+        assert work_queue.get() == ('b.note', 1)
+        assert work_queue.get(timeout=0) is None
+
+    def test_key_in_flight_is_not_handed_out(self):
+        work_queue = KeyedWorkQueue()
+        work_queue.put('a.note', 1)
+        assert work_queue.get() == ('a.note', 1)
+        work_queue.put('a.note', 2)
+        work_queue.put('a.note', 3)
+        assert work_queue.get(timeout=0.01) is None
+        threading.Timer(0.05, work_queue.done, args=('a.note', )).start()
+        assert work_queue.get(timeout=5) == ('a.note', 3)
+
+    def test_priority(self):
+        work_queue = KeyedWorkQueue()
+        for key in ['a.note', 'b.note', 'c.note']:
+            work_queue.put(key, 'backlog', BACKLOG_PRIORITY)
+        work_queue.put('d.note', 'live', LIVE_PRIORITY)
+        # Live change of a note waiting in the backlog moves it ahead
+        work_queue.put('b.note', 'live', LIVE_PRIORITY)
+        # Backlog item never delays a note already waiting with live priority
+        work_queue.put('d.note', 'backlog', BACKLOG_PRIORITY)
+        assert len(work_queue) == 4
+        assert [work_queue.get() for _ in range(4)] == [
+            ('d.note', 'backlog'), ('b.note', 'live'), ('a.note', 'backlog'), ('c.note', 'backlog')
+        ]
+
+
+class TestDaemonState(object):
+    def test_changed_paths(self, tmpdir):
+        notes = [tmpdir.join('{}.note'.format(i)) for i in range(3)]
+        for note in notes:
+            note.write(note.basename)
+        tmpdir.join('.hidden.note').write('')
+        tmpdir.join('0.note.tmp').write('')
+        paths = [str(note) for note in notes]
+        state = DaemonState(str(tmpdir.join('daemon.json')))
+        assert sorted(state.changed_paths(str(tmpdir))) == paths
+        for idx, path in enumerate(paths):
+            stat = os.stat(path)
+            state.set(path, NoteState('title {}'.format(idx), 'ev-{}'.format(idx), stat.st_size, stat.st_mtime_ns))
+        state.save()
+        state = DaemonState.load(str(tmpdir.join('daemon.json')))
+        assert state.get(paths[0]) == NoteState('title 0', 'ev-0', 6, os.stat(paths[0]).st_mtime_ns)
+        assert state.changed_paths(str(tmpdir)) == []
+
+        notes[0].write('changed')
+        notes[1].remove()
+        tmpdir.join('3.note').write('new')
+        assert sorted(state.changed_paths(str(tmpdir))) == [paths[0], paths[1], str(tmpdir.join('3.note'))]
+
+    def test_move(self):
+        state = DaemonState()
+        state.set('a.note', NoteState('a', 'ev-1', 1, 1))
+        state.move('a.note', 'b.note')
+        state.move('c.note', 'd.note')
+        assert state.get('a.note') is None
+        assert state.title('b.note') == 'a'
+        assert state.get('d.note') is None
+        state.move('b.note', 'b.note~')
+        assert state.title('b.note') == 'a'
+        assert state.get('b.note~') is None
+
+    def test_not_notes_ignored(self, tmpdir):
+        note = tmpdir.join('a.note')
+        note.write('a')
+        stat = os.stat(str(note))
+        state_file = tmpdir.join('daemon.json')
+        state_file.write(json.dumps({
+            str(note): ['a', 'ev-1', stat.st_size, stat.st_mtime_ns],
+            str(tmpdir.join('a.note~')): ['a', 'ev-1', 1, 1],
+        }))
+        state = DaemonState.load(str(state_file))
+        assert len(state) == 1
+        state.notes[str(tmpdir.join('b.note~'))] = NoteState('b', 'ev-2', 1, 1)
+        assert state.changed_paths(str(tmpdir)) == []
+
+    def test_load_corrupted(self, tmpdir):
+        state_file = tmpdir.join('daemon.json')
+        state_file.write('{"a.note": ')
+        assert len(DaemonState.load(str(state_file))) == 0
+        assert len(DaemonState.load(str(tmpdir.join('missing.json')))) == 0
+
+
+class TestNotesDaemon(object):
+    def test_update_rename_remove(self, tmpdir):
+        note = tmpdir.join('1.note')
+        note.write(TOMBOY_HEADER + """<title>Note</title>
+<text xml:space="preserve"><note-content version="0.1">Note</note-content></text>
+<last-change-date>2014-08-08T18:02:02.0980690+04:00</last-change-date>
+<create-date>2014-08-04T17:59:08.9297270+04:00</create-date></note>""")
+        store = FakeNoteStore()
+        daemon = NotesDaemon(Evernote('token', note_store=store), DaemonState(), str(tmpdir), quiet_period=0)
+        daemon.update_note(str(note))
+        assert daemon.state.get(str(note)) == NoteState('Note', 'ev-1', note.size(), os.stat(str(note)).st_mtime_ns)
+        assert daemon.state.changed_paths(str(tmpdir)) == []
+
+        # Renamed note stays the same Evernote note
+        daemon.changed(str(note))
+        note.rename(tmpdir.join('2.note'))
+        daemon.moved(str(note), str(tmpdir.join('2.note')))
+        assert daemon.debouncer.pop_due() == [str(tmpdir.join('2.note'))]
+        assert daemon.state.title(str(tmpdir.join('2.note'))) == 'Note'
+
+        tmpdir.join('2.note').remove()
+        daemon.remove_note(str(tmpdir.join('2.note')))
+        assert store.calls == ['findNotesMetadata', 'createNote', 'findNotesMetadata', 'deleteNote']
+        assert len(daemon.state) == 0
+
+    def test_tomboy_save(self, tmpdir):
+        note = tmpdir.join('x.note')
+        content = TOMBOY_HEADER + """<title>Note</title>
+<text xml:space="preserve"><note-content version="0.1">{}</note-content></text>
+<last-change-date>2014-08-08T18:02:02.0980690+04:00</last-change-date>
+<create-date>2014-08-04T17:59:08.9297270+04:00</create-date></note>"""
+        note.write(content.format('Note'))
+        store = FakeNoteStore()
+        daemon = NotesDaemon(Evernote('token', note_store=store), DaemonState(), str(tmpdir), quiet_period=0)
+        daemon.update_note(str(note))
+
+        # Tomboy writes the new version aside, moves the note away, puts the new version in its place
+        # and deletes the old one
+        paths = {name: str(tmpdir.join(name)) for name in ['x.note', 'x.note.tmp', 'x.note~']}
+        tmpdir.join('x.note.tmp').write(content.format('Note, edited'))
+        daemon.changed(paths['x.note.tmp'])
+        note.rename(tmpdir.join('x.note~'))
+        daemon.moved(paths['x.note'], paths['x.note~'])
+        tmpdir.join('x.note.tmp').rename(note)
+        daemon.moved(paths['x.note.tmp'], paths['x.note'])
+        tmpdir.join('x.note~').remove()
+        daemon.changed(paths['x.note~'])
+        assert daemon.debouncer.pop_due() == [paths['x.note']]
+        assert daemon.state.changed_paths(str(tmpdir)) == [paths['x.note']]
+
+        # Sync it the way workers do
+        for tomboy_note in daemon.state.changed_paths(str(tmpdir)):
+            daemon.update_note(tomboy_note) if os.path.isfile(tomboy_note) else daemon.remove_note(tomboy_note)
+        assert 'deleteNote' not in store.calls
+        assert [n.content for n in store.notes.values()] == [daemon.converter.convert(str(note))['content']]
+        assert daemon.state.changed_paths(str(tmpdir)) == []
+
+    def test_flush_hands_notes_to_workers(self, tmpdir):
+        class NoRescanDaemon(NotesDaemon):
+            def reconcile(self):
+                pass
+
+        store = FakeNoteStore()
+        uploading, uploaded = threading.Event(), threading.Event()
+        create_note = store.createNote
+
+        def slow_create_note(note):
+            uploading.set()
+            assert uploaded.wait(5)
+            return create_note(note)
+
+        store.createNote = slow_create_note
+        daemon = NoRescanDaemon(Evernote('token', note_store=store), DaemonState(), str(tmpdir), quiet_period=0,
+                                workers=2)
+        note = tmpdir.join('1.note')
+        note.write(TOMBOY_HEADER + """<title>Note</title>
+<text xml:space="preserve"><note-content version="0.1">Note</note-content></text>
+<last-change-date>2014-08-08T18:02:02.0980690+04:00</last-change-date>
+<create-date>2014-08-04T17:59:08.9297270+04:00</create-date></note>""")
+        daemon.changed(str(note))
+        # The upload is still in progress when flush returns
+        daemon.flush()
+        assert uploading.wait(5)
+        assert not uploaded.is_set()
+        uploaded.set()
+
+        assert wait_for(lambda: daemon.state.title(str(note)) == 'Note')
+        assert [n.title for n in store.notes.values()] == ['Note']
+
+        note.remove()
+        daemon.changed(str(note))
+        daemon.flush()
+        assert wait_for(lambda: len(daemon.state) == 0)
+        assert store.notes == {}
+        assert store.calls.count('deleteNote') == 1
+        assert all(worker.is_alive() for worker in daemon.workers)
+
+    def test_overflow_rescan(self, tmpdir):
+        state = DaemonState()
+        for name in ['a.note', 'b.note', 'c.note']:
+            tmpdir.join(name).write(name)
+            stat = os.stat(str(tmpdir.join(name)))
+            state.set(str(tmpdir.join(name)), NoteState(name, 'ev-' + name, stat.st_size, stat.st_mtime_ns))
+        gone = str(tmpdir.join('gone.note'))
+        state.set(gone, NoteState('Gone', 'ev-gone', 1, 1))
+        daemon = NotesDaemon(Evernote('token', note_store=FakeNoteStore()), state, str(tmpdir), quiet_period=60)
+        # Only the reconciler runs, so the queue is not consumed
+        threading.Thread(target=daemon.reconcile, daemon=True).start()
+        assert wait_for(lambda: len(daemon.work_queue) == 1)
+        assert daemon.work_queue.get(0)[0] == gone
+        daemon.work_queue.done(gone)
+        state.pop(gone)
+
+        # Changes the watcher missed: b changed, d created. c changed too, but it waits for its quiet period anyway
+        tmpdir.join('b.note').write('changed')
+        tmpdir.join('c.note').write('changed')
+        tmpdir.join('d.note').write('d')
+        daemon.changed(str(tmpdir.join('c.note')))
+        daemon.overflowed()
+        assert wait_for(lambda: len(daemon.work_queue) == 2)
+        assert daemon.work_queue.priorities == {
+            str(tmpdir.join('b.note')): BACKLOG_PRIORITY, str(tmpdir.join('d.note')): BACKLOG_PRIORITY
+        }
+        assert daemon.debouncer.pending.keys() == {str(tmpdir.join('c.note'))}
+
+    def test_rescan_interval(self, tmpdir):
+        daemon = NotesDaemon(Evernote('token', note_store=FakeNoteStore()), DaemonState(), str(tmpdir),
+                             rescan_interval=0.05)
+        threading.Thread(target=daemon.reconcile, daemon=True).start()
+        tmpdir.join('a.note').write('a')
+        assert wait_for(lambda: len(daemon.work_queue) == 1)
+        assert daemon.work_queue.priorities == {str(tmpdir.join('a.note')): BACKLOG_PRIORITY}
+
+
+class RecordingDaemon(object):
+    def __init__(self):
+        self.events = []
+
+    def changed(self, path):
+        self.events.append(('changed', os.path.basename(path)))
+
+    def moved(self, src_path, dst_path):
+        self.events.append(('moved', os.path.basename(src_path), os.path.basename(dst_path)))
+
+
+class TestPollingWatcher(object):
+    def test_scan(self, tmpdir):
+        for name in ['a.note', 'b.note', 'c.note']:
+            tmpdir.join(name).write(name)
+        watcher = PollingWatcher(str(tmpdir))
+        watcher.files = watcher.listing()
+        daemon = RecordingDaemon()
+        assert watcher.scan(daemon) is False
+
+        tmpdir.join('a.note').write('changed')
+        tmpdir.join('b.note').rename(tmpdir.join('d.note'))
+        tmpdir.join('c.note').remove()
+        tmpdir.join('e.note').write('new')
+        assert watcher.scan(daemon) is True
+        assert sorted(daemon.events) == [('changed', 'a.note'), ('changed', 'c.note'), ('changed', 'e.note'),
+                                         ('moved', 'b.note', 'd.note')]
+        assert watcher.scan(daemon) is False
+
+    def test_adjust_interval(self):
+        watcher = PollingWatcher('.', min_interval=1, max_interval=5)
+        for _ in range(10):
+            watcher.adjust_interval(0.001, False)
+        assert watcher.interval == 5
+        watcher.adjust_interval(0.001, True)
+        assert watcher.interval == 1
+        # Slow scans are spaced to use at most 1% of CPU time
+        watcher.adjust_interval(0.2, True)
+        assert watcher.interval == pytest.approx(20)
+
+
+class TestSyncManifest(object):
+    def test_changed_files(self, tmpdir):
+        manifest = SyncManifest(str(tmpdir.join('manifest.sqlite')))
+        notes = [tmpdir.join('{}.note'.format(i)) for i in range(3)]
+        for note in notes:
+            note.write(note.basename)
+        paths = [str(note) for note in notes]
+        states = manifest.changed_files(paths)
+        assert [state.path for state in states] == paths
+        for state in states:
+            manifest.record(state, 'ev-{}'.format(state.path), 1)
+        assert manifest.changed_files(paths) == []
+
+        # Touched file with the same contents is not reported
+        os.utime(paths[0], ns=(1, 1))
+        notes[1].write('changed')
+        manifest = SyncManifest(str(tmpdir.join('manifest.sqlite')))
+        assert [state.path for state in manifest.changed_files(paths)] == [paths[1]]
+        assert manifest.get(paths[0]).mtime_ns == 1
+        assert manifest.get(paths[0]).evernote_guid == 'ev-{}'.format(paths[0])
+
+    def test_forget_missing(self, tmpdir):
+        manifest = SyncManifest(str(tmpdir.join('manifest.sqlite')))
+        note = tmpdir.join('1.note')
+        note.write('1')
+        for state in manifest.changed_files([str(note)]):
+            manifest.record(state)
+        manifest.forget_missing([])
+        assert manifest.get(str(note)) is None
+
+
+class PicklingCounter(TomboyConverter):
+    pickled = 0
+
+    def __getstate__(self):
+        PicklingCounter.pickled += 1
+        return super(PicklingCounter, self).__getstate__()
+
+
+class TestConvertNotes(object):
+    def test_parallel_conversion(self, tmpdir):
+        paths = []
+        for i in range(10):
+            note = tmpdir.join('{}.note'.format(i))
+            note.write(TOMBOY_HEADER + """<title>Note {}</title>
+<text xml:space="preserve"><note-content version="0.1">Note {}</note-content></text>
+<last-change-date>2014-08-08T18:02:02.0980690+04:00</last-change-date>
+<create-date>2014-08-04T17:59:08.9297270+04:00</create-date></note>""".format(i, i))
+            paths.append(str(note))
+        tmpdir.join('5.note').write('broken')
+        results = convert_notes(paths, jobs=3)
+        assert [ev_note['title'] if ev_note else None for ev_note, _ in results] == \
+            ['Note {}'.format(i) if i != 5 else None for i in range(10)]
+        assert [bool(error) for _, error in results] == [i == 5 for i in range(10)]
+        assert results == convert_notes(paths)
+        # Converter is sent to the worker processes along with the notes
+        assert results == convert_notes(paths, jobs=3, converter=TomboyConverter(engine='xslt'))
+        # The same pool converts several batches, the converter is sent to each process once
+        converter = PicklingCounter(engine='xslt')
+        with new_process_pool(3, converter) as executor:
+            assert convert_notes(paths[:5], jobs=3, executor=executor) + \
+                convert_notes(paths[5:], jobs=3, executor=executor) == results
+        assert 1 <= PicklingCounter.pickled <= 3
+
+
+class TestDates(object):
+    def test_parse_tomboy_date(self):
+        for text in ['2014-08-04T17:59:08.9297270+04:00', '2014-12-31T23:59:59.0000001-05:30',
+                     '2014-08-04T17:59:08Z', '2014-08-04T17:59:08.5', '2014-08-04T17:59:08+0100', '20140804T175908']:
+            date = parse_tomboy_date(text)
+            assert date == isodate.parse_datetime(text)
+            assert '{}'.format(date) == '{}'.format(isodate.parse_datetime(text))
+
+    def test_tomboy_timestamp(self):
+        assert tomboy_timestamp('2014-08-04T17:59:08.9297270+04:00') == 1407160748929
+        assert tomboy_timestamp('2014-08-04T13:59:08.9297270Z') == 1407160748929
+        assert tomboy_timestamp('2014-08-04T08:59:08.9297270-05:00') == 1407160748929
+
+
+class TestTomboyConverter(object):
+    NOTE = TOMBOY_HEADER + """<title>Hello</title>
+<text xml:space="preserve"><note-content version="0.1">Hello
+{}</note-content></text>
+<last-change-date>2014-08-08T18:02:02.0980690+04:00</last-change-date>
+<create-date>2014-08-04T17:59:08.9297270+04:00</create-date></note>"""
+
+    def test_convert_bytes(self, tmpdir):
+        data = self.NOTE.format('<bold>text</bold>').encode('utf-8')
+        note = tmpdir.join('guid.note')
+        note.write_binary(data)
+        converter = TomboyConverter()
+        ev_note = converter.convert_bytes(data)
+        assert ev_note['content'].endswith('<en-note><strong>text</strong><br clear="none"/></en-note>')
+        assert (ev_note['path'], ev_note['guid']) == (None, None)
+        assert converter.convert_bytes(data, str(note)) == converter.convert(str(note))
+        assert converter.convert(str(note))['guid'] == 'guid'
+
+    def test_huge_tree(self):
+        depth = 300
+        data = self.NOTE.format('<list><list-item>' * depth + 'item' + '</list-item></list>' * depth).encode('utf-8')
+        with pytest.raises(xml.XMLSyntaxError):
+            TomboyConverter().convert_bytes(data)
+        ev_note = TomboyConverter(huge_tree=True).convert_bytes(data)
+        assert ev_note['content'].endswith('<en-note>{}item{}</en-note>'.format('<ul><li>' * depth, '</li></ul>' * depth))
+
+    def test_threads(self):
+        converter = TomboyConverter()
+        parsers = []
+        results = []
+
+        def convert(idx):
+            parsers.append(converter.parser)
+            results.append(converter.convert_bytes(self.NOTE.format(idx).encode('utf-8'))['content'])
+
+        threads = [threading.Thread(target=convert, args=(idx, )) for idx in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(set(id(parser) for parser in parsers)) == 4
+        assert sorted(results) == sorted(converter.convert_bytes(self.NOTE.format(idx).encode('utf-8'))['content']
+                                         for idx in range(4))
+        assert converter.parser is converter.parser
+
+    def test_scan(self, tmpdir):
+        note = tmpdir.join('note.note')
+        converter = TomboyConverter()
+        for tags in ['', '<tags><tag>system:notebook:Work</tag><tag>tag</tag></tags>']:
+            note.write(TOMBOY_HEADER + """<title> </title>
+<text xml:space="preserve"><note-content version="0.1"> <text>not a note element</text></note-content></text>
+<last-change-date>2014-08-08T18:02:02.0980690+04:00</last-change-date>
+<create-date>2014-08-04T17:59:08.9297270+04:00</create-date>{}
+<open-on-startup>False</open-on-startup></note>""".format(tags))
+            header = converter.scan(str(note))
+            ev_note = converter.convert(str(note))
+            assert header == NoteHeader(ev_note['title'], ev_note['tags'], ev_note['notebook'], ev_note['created'],
+                                        ev_note['updated'], False)
+        assert header.notebook == 'Work'
+        note.write(self.NOTE.format('').replace('</note>', '<tags><tag>system:template</tag></tags></note>'))
+        assert converter.scan(str(note)).template
+
+
+class TestNoteSelector(object):
+    def test_matches(self):
+        header = NoteHeader('Work report', ['tag1', 'tag2'], 'Work', 0, 0, False)
+        assert NoteSelector().matches(header)
+        assert not NoteSelector().matches(header._replace(template=True))
+        assert NoteSelector(notebook='Work', tags=['tag2', 'tag3'], title_regex='report$').matches(header)
+        assert not NoteSelector(notebook='Home').matches(header)
+        assert not NoteSelector(tags=['tag3']).matches(header)
+        assert not NoteSelector(title_regex='^report').matches(header)
+
+
 class TestT2EvConverter(object):
     @pytest.fixture
     def tomboy_note(self, request):
@@ -36,8 +1109,10 @@ class TestT2EvConverter(object):
         with open(note, 'w') as f:
             f.write(TOMBOY_HEADER)
             f.write(tomboy_xml)
-        ev_note = convert_tomboy_to_evernote(note)
-        assert ev_note['content'] == evernote_xml
+        # Both engines must produce the same ENML
+        for engine in ENGINES:
+            ev_note = convert_tomboy_to_evernote(note, engine=engine)
+            assert ev_note['content'] == evernote_xml
 
     def test_empty_title_error(self, tomboy_note):
         """ Empty title should be replaced with note creation date """
@@ -209,4 +1284,33 @@ normal font
 <create-date>2014-08-04T17:59:08.9297270+04:00</create-date></note>''',
                                '''<?xml version="1.0" encoding="UTF-8"?>
 <!DOCTYPE en-note SYSTEM "http://xml.evernote.com/pub/enml2.dtd">
-<en-note>Normal text with bla-bla. That&#x27;s it.<br clear="none"/></en-note>''')
\ No newline at end of file
+<en-note>Normal text with bla-bla. That&#x27;s it.<br clear="none"/></en-note>''')
+
+    def test_deeply_nested_list(self, tomboy_note):
+        depth = 5000
+        root = xml.fromstring((TOMBOY_HEADER + '''<title>Hello</title>
+<text xml:space="preserve"><note-content version="0.1">Hello
+</note-content></text>
+<last-change-date>2014-08-08T18:02:02.0980690+04:00</last-change-date>
+<create-date>2014-08-04T17:59:08.9297270+04:00</create-date></note>''').encode('utf-8'))
+        parent = root.find('{http://beatniksoftware.com/tomboy}text')[0]
+        for _ in range(depth):
+            parent = xml.SubElement(parent, '{http://beatniksoftware.com/tomboy}list')
+            parent = xml.SubElement(parent, '{http://beatniksoftware.com/tomboy}list-item')
+        parent.text = 'item'
+        ev_note = convert_tomboy_to_evernote(tomboy_note, root=root)
+        assert ev_note['content'].endswith('<en-note>{}item{}</en-note>'.format('<ul><li>' * depth, '</li></ul>' * depth))
+
+    def test_engines_match(self, tomboy_note):
+        with open(tomboy_note, 'w') as f:
+            f.write(TOMBOY_HEADER + '''<title>Hello</title>
+<text xml:space="preserve"><note-content version="0.1">Hello
+"Quotes" &amp; 'apostrophes' &lt;tag&gt; <bold>bold "text" &amp; <italic>more</italic> tail</bold>
+<link:url>www.example.com/a b?c=d&amp;e</link:url> <link:url>/home/user/file</link:url> <link:url></link:url>
+<list><list-item dir="ltr"><bold>item</bold> one <link:internal>Other note</link:internal>
+</list-item><list-item dir="ltr">item&#160;two<!-- comment --></list-item></list>
+<size:huge><size:small> nested </size:small></size:huge><unknown>a <b>b</b></unknown></note-content></text>
+<last-change-date>2014-08-08T18:02:02.0980690+04:00</last-change-date>
+<create-date>2014-08-04T17:59:08.9297270+04:00</create-date></note>''')
+        results = [convert_tomboy_to_evernote(tomboy_note, engine=engine) for engine in ENGINES]
+        assert all(result == results[0] for result in results)
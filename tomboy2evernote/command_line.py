@@ -3,15 +3,22 @@
 
 import argparse
 from datetime import timedelta, date
-import glob
 import os
+import re
 import sys
-
-import pyinotify
+import time
 
 from evernote.edam.error.ttypes import EDAMUserException
 
-from tomboy2evernote.tomboy2evernote import Evernote, convert_tomboy_to_evernote
+from tomboy2evernote.daemon import QUIET_PERIOD, MAX_DELAY, DaemonState, NotesDaemon
+from tomboy2evernote.index import NoteIndex
+from tomboy2evernote.manifest import SyncManifest
+from tomboy2evernote.mirror import RemoteMirror
+from tomboy2evernote.pipeline import Stage, batches, run_pipeline
+from tomboy2evernote.throttle import RateLimiter, RetryPolicy, ConcurrencyController
+from tomboy2evernote.tomboy2evernote import ENGINES, Evernote, NoteSelector, TomboyConverter, convert_notes, \
+    new_process_pool
+from tomboy2evernote.watchers import WATCHERS
 
 __author__ = 'Denis Kovalev (aikikode)'
 
@@ -22,6 +29,14 @@ if not os.path.isdir(CONFIG_DIR):
 if CONFIG_DIR not in sys.path:
     sys.path.append(CONFIG_DIR)
 CONFIG_FILE = os.path.join(CONFIG_DIR, 'settings.py')
+INDEX_FILE = os.path.join(CONFIG_DIR, 'index.sqlite')
+MIRROR_FILE = os.path.join(CONFIG_DIR, 'mirror.json')
+MANIFEST_FILE = os.path.join(CONFIG_DIR, 'manifest.sqlite')
+DAEMON_STATE_FILE = os.path.join(CONFIG_DIR, 'daemon.json')
+# Maximum number of concurrent uploads in adaptive mode if not set explicitly
+ADAPTIVE_MAX_WORKERS = 16
+# Number of notes to convert at once with --jobs, big enough to give every process several chunks of notes
+CONVERT_BATCH_SIZE = 256
 
 import logging
 logger = logging.getLogger(__name__)
@@ -48,20 +63,88 @@ def main():
     parser.add_argument('-t', action='store', choices=['day', 'week', 'month', 'all'], default='day',
                         help='Upload only notes modified during this period. Default: day', required=False)
     parser.add_argument('-d', '--daemon', action='store_true', help='Run as daemon', required=False)
+    parser.add_argument('--quiet-period', action='store', type=float, default=QUIET_PERIOD, required=False,
+                        help='Daemon uploads a changed note after no changes were made to it during this number of '
+                             'seconds. Default: {}'.format(QUIET_PERIOD))
+    parser.add_argument('--max-delay', action='store', type=float, default=MAX_DELAY, required=False,
+                        help='Daemon uploads a note under continuous editing at least once per this number of '
+                             'seconds. Default: {}'.format(MAX_DELAY))
+    parser.add_argument('--rescan-interval', action='store', type=float, default=0, required=False,
+                        help='Daemon also compares notes files with the uploaded ones every this number of seconds '
+                             'to catch changes inotify missed, e.g. during suspend. Default: 0 (never)')
+    parser.add_argument('--watcher', action='store', choices=sorted(WATCHERS), default='inotify', required=False,
+                        help='How daemon finds out about notes changes. Use poll if notes are on NFS, sshfs or other '
+                             'filesystem inotify gets no events from. Default: inotify')
+    parser.add_argument('--prefetch', action='store_true', required=False,
+                        help='Download all Evernote notes metadata before uploading instead of searching '
+                             'for every note. Faster for large uploads. Next runs download only the changes')
+    parser.add_argument('-i', '--incremental', action='store_true', required=False,
+                        help='Upload only notes changed since the last successful upload, ignores -t')
+    parser.add_argument('-j', '--jobs', action='store', type=int, default=1, required=False,
+                        help='Number of processes to convert notes with. Default: 1')
+    parser.add_argument('--engine', action='store', choices=ENGINES, default='python', required=False,
+                        help='How to convert notes contents: with Python code or with XSLT stylesheet. '
+                             'The result is the same. Default: python')
+    parser.add_argument('--huge-notes', action='store_true', required=False,
+                        help='Allow very large or very deeply nested notes, which are rejected by default')
+    parser.add_argument('--notebook', action='store', default=None, required=False,
+                        help='Upload only notes from this notebook. Not used in daemon mode')
+    parser.add_argument('--tag', action='append', default=None, required=False,
+                        help='Upload only notes with this tag, can be repeated to upload notes with any of the tags. '
+                             'Not used in daemon mode')
+    parser.add_argument('--title-regex', action='store', type=re.compile, default=None, required=False,
+                        help='Upload only notes whose title matches this regular expression. Not used in daemon mode')
+    parser.add_argument('-w', '--workers', action='store', type=int, default=1, required=False,
+                        help='Number of notes to upload concurrently, also in daemon mode. Default: 1')
+    parser.add_argument('--adaptive', action='store_true', required=False,
+                        help='Adjust the number of concurrent uploads to the service response times and rate limits, '
+                             'up to --workers if it is set, otherwise up to {}'.format(ADAPTIVE_MAX_WORKERS))
+    parser.add_argument('--rate', action='store', type=float, default=None, required=False,
+                        help='Maximum number of Evernote API calls per second. Default: no limit')
+    parser.add_argument('--retries', action='store', type=int, default=4, required=False,
+                        help='Number of times to repeat Evernote API call failed with temporary error. Default: 4')
     args = parser.parse_args()
 
     try:
-        evernote = Evernote(token=get_token())
+        concurrency = None
+        if args.adaptive:
+            args.workers = args.workers if args.workers > 1 else ADAPTIVE_MAX_WORKERS
+            concurrency = ConcurrencyController(maximum=args.workers)
+        evernote = Evernote(token=get_token(), index=NoteIndex(INDEX_FILE), rate_limiter=RateLimiter(args.rate),
+                            retry_policy=RetryPolicy(attempts=args.retries + 1), concurrency=concurrency)
     except EDAMUserException as ex:
         sys.exit(ex.errorCode)
 
+    converter = TomboyConverter(engine=args.engine, huge_tree=args.huge_notes)
+    if args.prefetch:
+        evernote.prefetch(RemoteMirror.load(MIRROR_FILE))
     if args.daemon:
-        run_as_daemon(evernote)
+        run_as_daemon(evernote, quiet_period=args.quiet_period, max_delay=args.max_delay, workers=args.workers,
+                      rescan_interval=args.rescan_interval, watcher=args.watcher, converter=converter)
     else:
-        convert_all_tomboy_notes(evernote, args.t)
+        manifest = SyncManifest(MANIFEST_FILE) if args.incremental else None
+        selector = None
+        if args.notebook is not None or args.tag or args.title_regex is not None:
+            selector = NoteSelector(notebook=args.notebook, tags=args.tag, title_regex=args.title_regex)
+        convert_all_tomboy_notes(evernote, args.t, manifest=manifest, jobs=args.jobs, workers=args.workers,
+                                 converter=converter, selector=selector)
+        if evernote.mirror is not None:
+            evernote.mirror.save()
+
+
+class NoteJob(object):
+    """ Tomboy note passing through the upload pipeline """
+    def __init__(self, path, state=None):
+        self.path = path
+        self.state = state  # FileState to record in the sync manifest after upload
+        self.root = None  # parsed note XML
+        self.ev_note = None  # converted note
+        self.note = None  # uploaded note metadata
+        self.error = None
 
 
-def convert_all_tomboy_notes(evernote, modified_time=None):
+def scan_notes(modified_time=None, manifest=None):
+    """ Yield NoteJob for every Tomboy note that should be uploaded, see convert_all_tomboy_notes """
     delta = timedelta.max
     if modified_time == 'day':
         delta = timedelta(days=1)
@@ -70,26 +153,133 @@ def convert_all_tomboy_notes(evernote, modified_time=None):
     elif modified_time == 'month':
         delta = timedelta(weeks=4)
     today = date.today()
-    notes_files = list(filter(lambda f: delta > today - date.fromtimestamp(os.path.getmtime(f)),
-                              glob.glob(os.path.join(TOMBOY_DIR, "*.note"))))
-    total_notes = len(notes_files)
+    notes_files = []
+    with os.scandir(TOMBOY_DIR) as entries:
+        for entry in entries:
+            if entry.name.startswith('.') or not entry.name.endswith('.note') or not entry.is_file():
+                continue
+            notes_files.append(entry.path)
+            if manifest is not None:
+                state = manifest.changed(entry.path, entry.stat())
+                if state is not None:
+                    yield NoteJob(entry.path, state)
+            elif delta > today - date.fromtimestamp(entry.stat().st_mtime):
+                yield NoteJob(entry.path)
+    if manifest is not None:
+        manifest.forget_missing(notes_files)
+
+
+def convert_all_tomboy_notes(evernote, modified_time=None, manifest=None, jobs=1, workers=1, converter=None,
+                             selector=None):
+    """ Upload Tomboy notes to Evernote
+    Notes are scanned, parsed, converted and uploaded by separate pipeline stages, so the first note
+    is uploaded right away and disk, CPU and network work simultaneously. With several jobs notes are
+    parsed and converted by the process pool in batches of CONVERT_BATCH_SIZE.
+    Arguments:
+    evernote      -- Evernote client
+    modified_time -- upload only notes modified during this period: 'day', 'week', 'month' or None for all notes
+    manifest      -- SyncManifest: if set, upload exactly the notes changed since the last successful upload
+                     instead of filtering by modified_time
+    jobs          -- number of processes to convert notes with
+    workers       -- number of threads to upload notes with, each of them uses its own connection.
+                     If evernote client has concurrency controller, it decides how many of them upload at once
+    converter     -- TomboyConverter to convert notes with, the default one if it's not set
+    selector      -- NoteSelector: if set, upload only the notes it selects by their headers.
+                     Other notes are neither parsed in full nor recorded in the manifest
+    Returns dictionary of Tomboy note path -> note title
+    """
+    converter = converter or TomboyConverter()
+
+    def select(note_jobs):
+        for job in note_jobs:
+            try:
+                header = converter.scan(job.path)
+            except Exception:
+                # Let the conversion report the broken note
+                yield job
+                continue
+            if selector.matches(header):
+                yield job
+
+    def parse(job):
+        try:
+            job.root = converter.parse(job.path)
+        except Exception as ex:
+            job.error = ex
+        return job
+
+    def convert(job):
+        if job.error is None:
+            try:
+                job.ev_note = converter.convert(job.path, root=job.root)
+            except Exception as ex:
+                job.error = ex
+            job.root = None
+        return job
+
+    def parse_and_convert_in_processes(note_jobs):
+        # Notes go to the process pool in batches, each worker gets a chunk of them per round trip
+        for batch in batches(note_jobs, CONVERT_BATCH_SIZE):
+            results = convert_notes([job.path for job in batch], jobs=jobs, converter=converter, executor=pool)
+            for job, (ev_note, error) in zip(batch, results):
+                job.ev_note, job.error = ev_note, error
+                yield job
+
+    def upload(job):
+        if job.ev_note:
+            if evernote.concurrency is not None:
+                evernote.concurrency.acquire()
+            started = time.monotonic()
+            latency = None
+            try:
+                job.note = evernote.create_or_update_note(job.ev_note)
+                latency = time.monotonic() - started
+            except Exception as ex:
+                job.error = ex
+            finally:
+                if evernote.concurrency is not None:
+                    evernote.concurrency.release(latency)
+        return job
+
     failed_notes = []
     notes_hash = dict()
-    for idx, tomboy_note in enumerate(notes_files):
-        print('[{}/{}]:'.format(idx + 1, total_notes), end=' ')
-        ev_note = convert_tomboy_to_evernote(tomboy_note)
-        if ev_note:
-            print('Converted \'{}\'. Uploading...'.format(ev_note['title']), end=' ')
-            try:
-                evernote.create_or_update_note(ev_note)
-            except:
-                failed_notes.append(ev_note['title'])
-                print('FAILED')
+    pool = new_process_pool(jobs, converter) if jobs > 1 else None
+    note_jobs = scan_notes(modified_time, manifest)
+    if selector is not None:
+        note_jobs = select(note_jobs)
+    if pool is not None:
+        note_jobs = parse_and_convert_in_processes(note_jobs)
+        stages = [Stage(upload, workers)]
+    else:
+        stages = [Stage(parse, 1), Stage(convert, 1), Stage(upload, workers)]
+    try:
+        for idx, job in enumerate(run_pipeline(note_jobs, stages)):
+            print('[{}]:'.format(idx + 1), end=' ')
+            if job.ev_note is None and job.error:
+                failed_notes.append(job.path)
+                print('Failed to convert \'{}\': {}'.format(job.path, job.error))
+            elif job.ev_note:
+                print('Converted \'{}\'. Uploading...'.format(job.ev_note['title']), end=' ')
+                if job.error:
+                    failed_notes.append(job.ev_note['title'])
+                    print('FAILED')
+                else:
+                    print('OK')
+                    if job.state is not None:
+                        manifest.record(job.state, job.note.guid, job.note.updateSequenceNum)
+                notes_hash[job.path] = job.ev_note['title']
             else:
-                print('OK')
-            notes_hash[tomboy_note] = ev_note['title']
-        else:
-            print('Skipped template note')
+                print('Skipped template note')
+                if job.state is not None:
+                    manifest.record(job.state)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    if evernote.stats['skipped'] or evernote.stats['metadata_updated']:
+        print('Upload avoided for {} unchanged notes, {} notes got only metadata update'.format(
+            evernote.stats['skipped'], evernote.stats['metadata_updated']))
+    if evernote.concurrency is not None:
+        print('Upload concurrency: {}'.format(evernote.concurrency))
     if failed_notes:
         print('The following notes failed to upload:')
         for idx, note_title in enumerate(failed_notes):
@@ -97,61 +287,28 @@ def convert_all_tomboy_notes(evernote, modified_time=None):
     return notes_hash
 
 
-def run_as_daemon(evernote_client):
-    # First we need to get all current notes and their titles to correctly handle note deletion
-    notes = convert_all_tomboy_notes(evernote_client)
-
-    # Configure daemon
-    wm = pyinotify.WatchManager()
-    mask = pyinotify.IN_DELETE | pyinotify.IN_CREATE | pyinotify.IN_MODIFY | \
-           pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM
-
-    class EventHandler(pyinotify.ProcessEvent):
-        def my_init(self, evernote, notes_hash):
-            self.evernote = evernote
-            self.notes_hash = notes_hash
-
-        def process_IN_CREATE(self, event):
-            self.process_IN_MOVED_TO(event)
-
-        def process_IN_DELETE(self, event):
-            self.process_IN_MOVED_FROM(event)
-
-        def process_IN_MODIFY(self, event):
-            self.process_IN_MOVED_TO(event)
-
-        def process_IN_MOVED_TO(self, event):
-            # New note / Modify note
-            tomboy_note = event.pathname
-            if os.path.isfile(tomboy_note) and os.path.splitext(tomboy_note)[1] == '.note':
-                ev_note = convert_tomboy_to_evernote(tomboy_note)
-                if ev_note:
-                    try:
-                        self.evernote.create_or_update_note(ev_note)
-                        self.notes_hash[tomboy_note] = ev_note['title']
-                        logger.info('Updated \'{}\''.format(ev_note['title']))
-                    except:
-                        logger.error('ERROR: Failed to upload \'{}\' note'.format(ev_note['title']))
-
-        def process_IN_MOVED_FROM(self, event):
-            # Delete note
-            tomboy_note = event.pathname
-            note_title = self.notes_hash.get(tomboy_note)
-            if note_title:
-                try:
-                    self.evernote.remove_note(note_title)
-                    logger.info('Deleted \'{}\''.format(note_title))
-                    self.notes_hash.pop(tomboy_note, None)
-                except:
-                    logger.error('ERROR: Failed to delete "{}" note'.format(note_title))
-
-    handler = EventHandler(evernote=evernote_client, notes_hash=notes)
-    notifier = pyinotify.Notifier(wm, handler)
-    wm.add_watch(TOMBOY_DIR, mask, rec=False)
+def run_as_daemon(evernote_client, quiet_period=QUIET_PERIOD, max_delay=MAX_DELAY, workers=1, rescan_interval=None,
+                  watcher='inotify', converter=None):
+    """ Watch Tomboy notes directory and upload every change to Evernote, see NotesDaemon
+    Arguments:
+    evernote_client -- Evernote client
+    quiet_period    -- number of seconds without new events for a note after which it is uploaded
+    max_delay       -- maximum number of seconds a note under continuous editing waits for upload
+    workers         -- number of threads to convert and upload notes with
+    rescan_interval -- number of seconds between directory scans, None or 0 to scan only on start
+                       and when the watcher misses events
+    watcher         -- how to find out about changes: 'inotify' or 'poll' for filesystems without inotify support
+    converter       -- TomboyConverter to convert notes with, the default one if it's not set
+    """
+    # Notes uploaded during the previous runs, needed to find out what changed while the daemon was
+    # not running and to know titles of deleted notes
+    state = DaemonState.load(DAEMON_STATE_FILE)
+    daemon = NotesDaemon(evernote_client, state, TOMBOY_DIR, quiet_period=quiet_period, max_delay=max_delay,
+                         workers=workers, rescan_interval=rescan_interval, converter=converter)
     try:
-        notifier.loop(daemonize=True, pid_file='/tmp/t2ev.pid', stdout='/tmp/t2ev.log')
-    except pyinotify.NotifierError as ex:
-        logger.exception('ERROR: notifier exception: {}'.format(ex))
+        WATCHERS[watcher](TOMBOY_DIR).run(daemon, pid_file='/tmp/t2ev.pid', stdout='/tmp/t2ev.log')
+    except OSError as ex:
+        logger.exception('ERROR: watcher exception: {}'.format(ex))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict, namedtuple
+import atexit
+import json
+import os
+import threading
+import time
+
+from tomboy2evernote.storage import save_json
+from tomboy2evernote.tomboy2evernote import TomboyConverter
+
+import logging
+logger = logging.getLogger(__name__)
+
+__author__ = 'Denis Kovalev (aikikode)'
+
+# Number of seconds without new events after which a changed note is uploaded
+QUIET_PERIOD = 2
+# Maximum number of seconds a note under continuous editing waits for upload
+MAX_DELAY = 60
+# Minimum number of seconds between two writes of the daemon state file
+STATE_SAVE_INTERVAL = 5
+# Work queue priorities: changes made while the daemon runs go ahead of the ones found by directory scans
+LIVE_PRIORITY = 0
+BACKLOG_PRIORITY = 1
+# Daemon checks Evernote account for changes not more often than this number of seconds
+MIRROR_MAX_AGE = 60
+
+NoteState = namedtuple('NoteState', ['title', 'evernote_guid', 'size', 'mtime_ns'])
+
+
+class Debouncer(object):
+    """ Coalesces bursts of events per key
+
+    A single note save produces several inotify events. Every event only postpones the key,
+    and the key is released once there were no new events for it during the quiet period,
+    but not later than max_delay seconds after the first event, so that a note edited nonstop
+    is still uploaded regularly.
+    """
+    def __init__(self, quiet_period=QUIET_PERIOD, max_delay=MAX_DELAY):
+        self.quiet_period = quiet_period
+        self.max_delay = max_delay
+        self.pending = {}  # key -> (time of the first event, time of the last event)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def touch(self, key, now=None):
+        now = time.monotonic() if now is None else now
+        first_event = self.pending[key][0] if key in self.pending else now
+        self.pending[key] = (first_event, now)
+
+    def discard(self, key):
+        self.pending.pop(key, None)
+
+    def pop_due(self, now=None):
+        """ Return keys that had no events during the quiet period or waited for too long and forget them """
+        now = time.monotonic() if now is None else now
+        due = [
+            key for key, (first_event, last_event) in self.pending.items()
+            if now - last_event >= self.quiet_period or now - first_event >= self.max_delay
+        ]
+        for key in due:
+            del self.pending[key]
+        return due
+
+
+class KeyedWorkQueue(object):
+    """ Work queue keeping only the latest item per key
+
+    A newer item replaces the one waiting for the same key, and an item is never handed out while
+    another item with the same key is being processed, so only the newest version of a note is uploaded
+    and uploads of one note never overlap. Items with lower priority value are handed out first,
+    items with the same priority in order of their keys' first put.
+    """
+    def __init__(self):
+        self.queues = {}  # priority -> OrderedDict of key -> item
+        self.priorities = {}  # key -> priority of its waiting item
+        self.in_flight = set()
+        self.condition = threading.Condition()
+
+    def __len__(self):
+        with self.condition:
+            return len(self.priorities)
+
+    def put(self, key, item, priority=LIVE_PRIORITY):
+        with self.condition:
+            old_priority = self.priorities.get(key)
+            if old_priority is not None and old_priority <= priority:
+                self.queues[old_priority][key] = item
+            else:
+                if old_priority is not None:
+                    del self.queues[old_priority][key]
+                self.queues.setdefault(priority, OrderedDict())[key] = item
+                self.priorities[key] = priority
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        """ Wait for an item whose key is not being processed and return (key, item) tuple
+        Returns None if there's none after timeout seconds
+        """
+        with self.condition:
+            key = self._wait_for_key(timeout)
+            if key is None:
+                return None
+            self.in_flight.add(key)
+            return key, self.queues[self.priorities.pop(key)].pop(key)
+
+    def _wait_for_key(self, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            for priority in sorted(self.queues):
+                for key in self.queues[priority]:
+                    if key not in self.in_flight:
+                        return key
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return None
+            self.condition.wait(remaining)
+
+    def done(self, key):
+        """ Mark the item with the key as processed """
+        with self.condition:
+            self.in_flight.discard(key)
+            self.condition.notify_all()
+
+
+def is_note(path):
+    """ Tell whether the file is a Tomboy note, not a hidden or temporary file like x.note~ """
+    name = os.path.basename(path)
+    return name.endswith('.note') and not name.startswith('.')
+
+
+def note_files(directory):
+    """ Return dictionary of Tomboy note path -> stat result for every note in the directory """
+    notes = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if not is_note(entry.name):
+                continue
+            try:
+                if entry.is_file():
+                    notes[entry.path] = entry.stat()
+            except FileNotFoundError:
+                pass
+    return notes
+
+
+class DaemonState(object):
+    """ Tomboy notes uploaded by the daemon: their Evernote title and GUID and the file stat at the upload time
+
+    It is saved between runs, so on start the daemon syncs only the notes that were changed, added
+    or deleted while it was not running.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.RLock()
+        self.notes = {}  # Tomboy note path -> NoteState
+        self.dirty = False
+        self.saved = None  # time of the last save
+
+    def __len__(self):
+        return len(self.notes)
+
+    def get(self, path):
+        return self.notes.get(path)
+
+    def title(self, path):
+        note = self.notes.get(path)
+        return note.title if note else None
+
+    def set(self, path, note_state):
+        with self.lock:
+            self.notes[path] = note_state
+            self.dirty = True
+
+    def pop(self, path):
+        with self.lock:
+            note = self.notes.pop(path, None)
+            self.dirty = self.dirty or note is not None
+            return note
+
+    def move(self, src_path, dst_path):
+        """ Note file was renamed, it's still the same Evernote note
+        Renames to files that are not notes are refused, the state of the note stays where it was
+        """
+        if not is_note(dst_path):
+            logger.debug('Not moving the state of {} to {}: not a note'.format(src_path, dst_path))
+            return
+        with self.lock:
+            note = self.notes.pop(src_path, None)
+            if note is not None:
+                self.notes[dst_path] = note
+                self.dirty = True
+
+    def changed_paths(self, directory):
+        """ Return paths of the notes that were added, changed or deleted since they were uploaded
+        Costs one stat() call per note
+        """
+        files = note_files(directory)
+        with self.lock:
+            changed = [
+                path for path, stat in files.items()
+                if path not in self.notes or
+                (self.notes[path].size, self.notes[path].mtime_ns) != (stat.st_size, stat.st_mtime_ns)
+            ]
+            return changed + [path for path in self.notes if path not in files and is_note(path)]
+
+    @staticmethod
+    def load(path):
+        """ Load the state saved earlier. Returns empty state if there's none or it is corrupted """
+        state = DaemonState(path)
+        try:
+            with open(path) as state_file:
+                state.notes = {
+                    note_path: NoteState(*note) for note_path, note in json.load(state_file).items()
+                    if is_note(note_path)
+                }
+        except FileNotFoundError:
+            pass
+        except (ValueError, AttributeError, TypeError) as ex:
+            logger.error('ERROR: Failed to load daemon state, all notes will be synced: {}'.format(ex))
+            state = DaemonState(path)
+        return state
+
+    def save(self, min_interval=0):
+        """ Save the state if it changed
+        Arguments:
+        min_interval -- don't save if it was saved less than this number of seconds ago
+        """
+        if not self.path or not self.dirty or \
+                (self.saved is not None and time.monotonic() - self.saved < min_interval):
+            return
+        with self.lock:
+            notes = dict(self.notes)
+            self.dirty = False
+        self.saved = time.monotonic()
+        try:
+            save_json(self.path, notes)
+        except OSError as ex:
+            self.dirty = True
+            logger.error('ERROR: Failed to save daemon state: {}'.format(ex))
+
+
+class NotesDaemon(object):
+    """ Uploads changes of Tomboy notes reported by a watcher, see tomboy2evernote.watchers
+
+    Watcher thread only reports the changes, notes are converted and uploaded by worker threads,
+    so a slow or rate limited API call never stops watching. Notes changed while the daemon
+    was not running or while the watcher missed events are found by background directory scans
+    and uploaded after the live changes.
+    """
+    def __init__(self, evernote, state, directory, quiet_period=QUIET_PERIOD, max_delay=MAX_DELAY, workers=1,
+                 rescan_interval=None, converter=None):
+        """
+        Arguments:
+        evernote        -- Evernote client
+        state           -- DaemonState of the notes uploaded before
+        directory       -- Tomboy notes directory
+        quiet_period    -- number of seconds without new events for a note after which it is uploaded,
+                           so that a burst of events produced by a single save results in one upload
+        max_delay       -- maximum number of seconds a note under continuous editing waits for upload
+        workers         -- number of threads to convert and upload notes with
+        rescan_interval -- number of seconds between directory scans, None or 0 to scan only on start
+                           and when the watcher reports that it missed events
+        converter       -- TomboyConverter to convert notes with, the default one if it's not set
+        """
+        self.evernote = evernote
+        self.state = state
+        self.directory = directory
+        self.debouncer = Debouncer(quiet_period, max_delay)
+        self.work_queue = KeyedWorkQueue()
+        self.workers = [None] * max(1, workers)
+        self.reconciler = None
+        self.rescan_interval = rescan_interval or None
+        self.converter = converter or TomboyConverter()
+        self.rescan = threading.Event()
+        # Watcher should call flush at least this often
+        self.tick = max(0.1, quiet_period / 4)
+
+    def changed(self, path):
+        """ File was written, created or deleted
+        Any change just postpones the note sync until events stop coming.
+        A note that is deleted or moved away for good is removed once its quiet period is over
+        """
+        if is_note(path):
+            self.debouncer.touch(path)
+
+    def moved(self, src_path, dst_path):
+        """ File was renamed inside the notes directory """
+        if is_note(src_path) and is_note(dst_path):
+            # Renamed note is the same Evernote note: update it under the new path instead
+            # of deleting it and creating a new one
+            self.debouncer.discard(src_path)
+            self.state.move(src_path, dst_path)
+        else:
+            # Tomboy saves a note by moving it aside to x.note~ and renaming a temporary file to x.note,
+            # so the note is synced once its quiet period is over, whether it was rewritten or removed
+            self.changed(src_path)
+        # Temporary file renamed over the note is a single update of it
+        self.changed(dst_path)
+
+    def overflowed(self):
+        """ Watcher lost some events, find the changes by comparing the files with the uploaded notes """
+        logger.warning('WARNING: Some notes changes were missed, rescanning Tomboy notes')
+        self.rescan.set()
+
+    def start_threads(self):
+        # Threads are started by the watcher loop and not on init since the process forks when it daemonizes
+        for idx, worker in enumerate(self.workers):
+            if worker is None or not worker.is_alive():
+                self.workers[idx] = threading.Thread(target=self.sync_notes, daemon=True)
+                self.workers[idx].start()
+        if self.reconciler is None:
+            self.reconciler = threading.Thread(target=self.reconcile, daemon=True)
+            self.reconciler.start()
+
+    def flush(self):
+        """ Queue notes whose quiet period is over. Called by the watcher regularly """
+        self.start_threads()
+        for tomboy_note in self.debouncer.pop_due():
+            # Note is read when a worker gets to it, so several changes waiting in the queue are uploaded once
+            self.work_queue.put(tomboy_note, time.monotonic())
+        self.state.save(STATE_SAVE_INTERVAL)
+
+    def reconcile(self):
+        # The directory is already watched, so nothing changed during the scan is missed.
+        # Unless something changed, a scan costs one stat() call per note
+        while True:
+            try:
+                changed_notes = self.state.changed_paths(self.directory)
+            except OSError as ex:
+                logger.error('ERROR: Failed to scan Tomboy notes: {}'.format(ex))
+                changed_notes = []
+            # Notes waiting for their quiet period to end will be queued anyway
+            changed_notes = [note for note in changed_notes if note not in self.debouncer.pending]
+            if changed_notes:
+                logger.info('Found {} changed notes'.format(len(changed_notes)))
+            for tomboy_note in changed_notes:
+                self.work_queue.put(tomboy_note, time.monotonic(), BACKLOG_PRIORITY)
+            self.rescan.wait(self.rescan_interval)
+            self.rescan.clear()
+
+    def sync_notes(self):
+        while True:
+            tomboy_note, _ = self.work_queue.get()
+            try:
+                if os.path.isfile(tomboy_note):
+                    self.update_note(tomboy_note)
+                else:
+                    self.remove_note(tomboy_note)
+            except Exception:
+                logger.exception('ERROR: Failed to sync \'{}\''.format(tomboy_note))
+            finally:
+                self.work_queue.done(tomboy_note)
+
+    def update_note(self, tomboy_note):
+        # New note / Modify note
+        stat = os.stat(tomboy_note)
+        ev_note = self.converter.convert(tomboy_note)
+        if not ev_note:
+            # Template note, remember it to not convert it again on the next start
+            self.state.set(tomboy_note, NoteState(None, None, stat.st_size, stat.st_mtime_ns))
+            return
+        if self.evernote.concurrency is not None:
+            self.evernote.concurrency.acquire()
+        started = time.monotonic()
+        latency = None
+        try:
+            self.evernote.sync_mirror(max_age=MIRROR_MAX_AGE)
+            note = self.evernote.create_or_update_note(ev_note)
+            latency = time.monotonic() - started
+            self.state.set(tomboy_note, NoteState(ev_note['title'], note.guid, stat.st_size, stat.st_mtime_ns))
+            logger.info('Updated \'{}\''.format(ev_note['title']))
+        except:
+            logger.error('ERROR: Failed to upload \'{}\' note'.format(ev_note['title']))
+        finally:
+            if self.evernote.concurrency is not None:
+                self.evernote.concurrency.release(latency)
+
+    def remove_note(self, tomboy_note):
+        # Delete note
+        note_title = self.state.title(tomboy_note)
+        if note_title:
+            try:
+                self.evernote.sync_mirror(max_age=MIRROR_MAX_AGE)
+                self.evernote.remove_note(note_title)
+                logger.info('Deleted \'{}\''.format(note_title))
+            except:
+                logger.error('ERROR: Failed to delete "{}" note'.format(note_title))
+                return
+        self.state.pop(tomboy_note)
+
+
+def daemonize(pid_file, stdout=os.devnull):
+    """ Detach the process from the terminal, the way pyinotify does it
+    Arguments:
+    pid_file -- file to write the daemon process id to, it must not exist
+    stdout   -- file to redirect stdout and stderr to
+    """
+    if os.path.lexists(pid_file):
+        raise FileExistsError('Cannot daemonize: pid file {} already exists'.format(pid_file))
+    if os.fork():
+        os._exit(0)
+    os.setsid()
+    if os.fork():
+        os._exit(0)
+    os.chdir('/')
+    os.umask(0o022)
+    os.dup2(os.open(os.devnull, os.O_RDONLY), 0)
+    fd_out = os.open(stdout, os.O_WRONLY | os.O_CREAT, 0o600)
+    os.dup2(fd_out, 1)
+    os.dup2(fd_out, 2)
+    fd_pid = os.open(pid_file, os.O_WRONLY | os.O_CREAT | os.O_NOFOLLOW | os.O_EXCL, 0o600)
+    os.write(fd_pid, '{}\n'.format(os.getpid()).encode('ascii'))
+    os.close(fd_pid)
+    atexit.register(os.unlink, pid_file)
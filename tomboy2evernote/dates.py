@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+import re
+
+import isodate
+
+import logging
+logger = logging.getLogger(__name__)
+
+__author__ = 'Denis Kovalev (aikikode)'
+
+# Tomboy writes dates as .NET 'yyyy-MM-ddTHH:mm:ss.fffffffzzz', e.g. 2014-08-04T17:59:08.9297270+04:00
+TOMBOY_DATE = re.compile(r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d+))?(?:(Z)|([+-])(\d\d):?(\d\d))?$')
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MILLISECOND = timedelta(milliseconds=1)
+
+
+@lru_cache(maxsize=1024)
+def parse_tomboy_date(text):
+    """ Parse Tomboy date into datetime, the same one isodate.parse_datetime returns
+    Creation and last change dates of a note are often the same, so the results are cached
+    and every distinct string is parsed once. Dates in other formats are left to isodate.
+    """
+    match = TOMBOY_DATE.match(text)
+    if match is None:
+        return isodate.parse_datetime(text)
+    year, month, day, hour, minute, second, fraction, utc, sign, offset_hours, offset_minutes = match.groups()
+    tzinfo = None
+    if utc:
+        tzinfo = timezone.utc
+    elif sign:
+        offset = timedelta(hours=int(offset_hours), minutes=int(offset_minutes))
+        tzinfo = timezone(-offset if sign == '-' else offset)
+    # Microseconds are the first 6 digits of the fraction, like isodate does
+    microsecond = int(fraction[:6].ljust(6, '0')) if fraction else 0
+    return datetime(int(year), int(month), int(day), int(hour), int(minute), int(second), microsecond, tzinfo)
+
+
+def tomboy_timestamp(text):
+    """ Convert Tomboy date to milliseconds from epoch, the way Evernote stores time
+    (https://dev.evernote.com/doc/reference/Types.html#Typedef_Timestamp).
+    Dates without UTC offset are taken as local time
+    """
+    date = parse_tomboy_date(text)
+    if date.tzinfo is None:
+        return int(date.timestamp() * 1000)
+    return (date - EPOCH) // MILLISECOND
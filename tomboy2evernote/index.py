@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+import sqlite3
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
+
+__author__ = 'Denis Kovalev (aikikode)'
+
+IndexEntry = namedtuple('IndexEntry', ['path', 'tomboy_guid', 'title', 'evernote_guid', 'usn'])
+
+
+class NoteIndex(object):
+    """ Persistent Tomboy note -> Evernote note mapping
+
+    Every note uploaded to Evernote is recorded here by its Tomboy file path, Tomboy GUID and title,
+    so that the next update can go straight to the known Evernote note without a remote search.
+    """
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS notes ('
+        ' path TEXT,'
+        ' tomboy_guid TEXT,'
+        ' title TEXT,'
+        ' evernote_guid TEXT PRIMARY KEY,'
+        ' usn INTEGER)',
+        'CREATE INDEX IF NOT EXISTS notes_path ON notes (path)',
+        'CREATE INDEX IF NOT EXISTS notes_tomboy_guid ON notes (tomboy_guid)',
+        'CREATE INDEX IF NOT EXISTS notes_title ON notes (title)',
+    )
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        with self.db:
+            for statement in NoteIndex.SCHEMA:
+                self.db.execute(statement)
+
+    def lookup(self, path=None, tomboy_guid=None, title=None):
+        """ Find Evernote note for the Tomboy note. The most specific key available wins:
+        Tomboy GUID first, then file path and only then note title.
+        Returns IndexEntry or None
+        """
+        for column, value in [('tomboy_guid', tomboy_guid), ('path', path), ('title', title), ]:
+            if value is None:
+                continue
+            with self.lock:
+                row = self.db.execute(
+                    'SELECT path, tomboy_guid, title, evernote_guid, usn FROM notes WHERE {} = ? LIMIT 1'.format(column),
+                    (value, )
+                ).fetchone()
+            if row:
+                return IndexEntry(*row)
+        return None
+
+    def store(self, evernote_guid, usn, title, path=None, tomboy_guid=None):
+        """ Remember the Evernote note the Tomboy note was uploaded to """
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM notes WHERE evernote_guid = ?', (evernote_guid, ))
+            if tomboy_guid is not None:
+                self.db.execute('DELETE FROM notes WHERE tomboy_guid = ?', (tomboy_guid, ))
+            if path is not None:
+                self.db.execute('DELETE FROM notes WHERE path = ?', (path, ))
+            self.db.execute(
+                'INSERT INTO notes (path, tomboy_guid, title, evernote_guid, usn) VALUES (?, ?, ?, ?, ?)',
+                (path, tomboy_guid, title, evernote_guid, usn)
+            )
+
+    def forget(self, evernote_guid):
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM notes WHERE evernote_guid = ?', (evernote_guid, ))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
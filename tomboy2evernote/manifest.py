@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+import hashlib
+import os
+import sqlite3
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
+
+__author__ = 'Denis Kovalev (aikikode)'
+
+FileState = namedtuple('FileState', ['path', 'size', 'mtime_ns', 'digest'])
+ManifestEntry = namedtuple('ManifestEntry', ['path', 'size', 'mtime_ns', 'digest', 'evernote_guid', 'usn'])
+
+
+def file_digest(path):
+    with open(path, 'rb') as note_file:
+        return hashlib.sha1(note_file.read()).hexdigest()
+
+
+class SyncManifest(object):
+    """ State of every Tomboy note file as of its last successful upload
+
+    Only notes whose size or modification time differ from the recorded ones are read to compare
+    their digest, the rest cost a single stat() call.
+    """
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS files ('
+        ' path TEXT PRIMARY KEY,'
+        ' size INTEGER,'
+        ' mtime_ns INTEGER,'
+        ' digest TEXT,'
+        ' evernote_guid TEXT,'
+        ' usn INTEGER)',
+    )
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        with self.db:
+            for statement in SyncManifest.SCHEMA:
+                self.db.execute(statement)
+        self.entries = {
+            row[0]: ManifestEntry(*row)
+            for row in self.db.execute('SELECT path, size, mtime_ns, digest, evernote_guid, usn FROM files')
+        }
+
+    def get(self, path):
+        return self.entries.get(path)
+
+    def changed(self, path, stat=None):
+        """ Return FileState of the file if it changed since it was recorded last time, otherwise None
+        Arguments:
+        path -- file path
+        stat -- file stat result if it is already known, e.g. from os.scandir
+        """
+        try:
+            stat = stat or os.stat(path)
+        except FileNotFoundError:
+            return None
+        entry = self.entries.get(path)
+        if entry and (entry.size, entry.mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+            return None
+        try:
+            state = FileState(path, stat.st_size, stat.st_mtime_ns, file_digest(path))
+        except FileNotFoundError:
+            return None
+        if entry and entry.digest == state.digest:
+            # File was touched but its contents are the same
+            self.record(state, entry.evernote_guid, entry.usn)
+            return None
+        return state
+
+    def changed_files(self, paths):
+        """ Return FileState of every file that changed since it was recorded last time """
+        return [state for state in (self.changed(path) for path in paths) if state is not None]
+
+    def record(self, state, evernote_guid=None, usn=None):
+        """ Remember the file state after successful upload """
+        entry = ManifestEntry(state.path, state.size, state.mtime_ns, state.digest, evernote_guid, usn)
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO files (path, size, mtime_ns, digest, evernote_guid, usn) '
+                'VALUES (?, ?, ?, ?, ?, ?)', entry
+            )
+            self.entries[state.path] = entry
+
+    def forget_missing(self, paths):
+        """ Drop records of files that are not among the provided paths anymore """
+        missing = set(self.entries) - set(paths)
+        with self.lock, self.db:
+            self.db.executemany('DELETE FROM files WHERE path = ?', [(path, ) for path in missing])
+            for path in missing:
+                del self.entries[path]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
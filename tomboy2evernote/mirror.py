@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+import binascii
+import json
+import threading
+
+from tomboy2evernote.storage import save_json
+
+import logging
+logger = logging.getLogger(__name__)
+
+__author__ = 'Denis Kovalev (aikikode)'
+
+RemoteNote = namedtuple('RemoteNote', ['guid', 'title', 'notebookGuid', 'updateSequenceNum',
+                                       'contentHash', 'contentLength', 'created', 'updated'])
+
+
+class RemoteMirror(object):
+    """ In-memory copy of notes and notebooks metadata of the Evernote account
+
+    It is built from sync chunks and then kept up to date with the results of create/update/delete calls,
+    so that checking whether a note exists is a dictionary lookup instead of a remote search.
+    """
+    def __init__(self, path=None):
+        self.path = path  # file to keep the mirror in between runs
+        self.lock = threading.RLock()
+        self.notes = {}  # note guid -> RemoteNote
+        self.titles = {}  # note title -> list of note guids
+        self.notebooks = {}  # notebook guid -> notebook name
+        self.update_count = 0  # highest USN already applied to the mirror
+        self.server_time = 0  # service time of the last sync in milliseconds from epoch
+
+    def __len__(self):
+        return len(self.notes)
+
+    def find(self, title):
+        """ Return RemoteNote with the provided title or None """
+        with self.lock:
+            guids = self.titles.get(title)
+            return self.notes[guids[0]] if guids else None
+
+    def add_note(self, note):
+        """ Add or replace note metadata. Notes moved to trash are removed from the mirror """
+        with self.lock:
+            if getattr(note, 'active', None) is False or getattr(note, 'deleted', None):
+                self.remove_note(note.guid)
+                return
+            old_note = self.notes.get(note.guid)
+            notebook_guid = note.notebookGuid or (old_note.notebookGuid if old_note else None)
+            self.remove_note(note.guid)
+            self.notes[note.guid] = RemoteNote(
+                note.guid, note.title, notebook_guid, note.updateSequenceNum,
+                note.contentHash, note.contentLength, note.created, note.updated
+            )
+            self.titles.setdefault(note.title, []).append(note.guid)
+
+    def remove_note(self, guid):
+        with self.lock:
+            note = self.notes.pop(guid, None)
+            if note is not None:
+                guids = self.titles[note.title]
+                guids.remove(guid)
+                if not guids:
+                    del self.titles[note.title]
+
+    def add_notebook(self, notebook):
+        with self.lock:
+            self.notebooks[notebook.guid] = notebook.name
+
+    def apply_chunk(self, chunk):
+        """ Apply SyncChunk returned by getSyncChunk/getFilteredSyncChunk """
+        with self.lock:
+            for note in chunk.notes or []:
+                self.add_note(note)
+            for notebook in chunk.notebooks or []:
+                self.add_notebook(notebook)
+            for guid in chunk.expungedNotes or []:
+                self.remove_note(guid)
+            for guid in chunk.expungedNotebooks or []:
+                self.notebooks.pop(guid, None)
+            if chunk.chunkHighUSN is not None:
+                self.update_count = max(self.update_count, chunk.chunkHighUSN)
+            self.server_time = chunk.currentTime or self.server_time
+
+    @staticmethod
+    def load(path):
+        """ Load the mirror saved earlier. Returns empty mirror if there's none or it is corrupted """
+        mirror = RemoteMirror(path)
+        try:
+            with open(path) as mirror_file:
+                data = json.load(mirror_file)
+            for note in data['notes']:
+                note = RemoteNote(*note)
+                if note.contentHash is not None:
+                    note = note._replace(contentHash=binascii.unhexlify(note.contentHash))
+                mirror.notes[note.guid] = note
+                mirror.titles.setdefault(note.title, []).append(note.guid)
+            mirror.notebooks = data['notebooks']
+            mirror.update_count = data['update_count']
+            mirror.server_time = data['server_time']
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, TypeError) as ex:
+            logger.error('ERROR: Failed to load remote notes mirror, full sync is required: {}'.format(ex))
+            mirror = RemoteMirror(path)
+        return mirror
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            notes = list(self.notes.values())
+            notebooks = dict(self.notebooks)
+        data = {
+            'update_count': self.update_count,
+            'server_time': self.server_time,
+            'notebooks': notebooks,
+            'notes': [
+                note._replace(contentHash=binascii.hexlify(note.contentHash).decode('ascii'))
+                if note.contentHash is not None else note
+                for note in notes
+            ],
+        }
+        save_json(self.path, data)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+import queue
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
+
+__author__ = 'Denis Kovalev (aikikode)'
+
+# Maximum number of items waiting between two stages
+QUEUE_SIZE = 64
+
+Stage = namedtuple('Stage', ['func', 'workers'])
+
+_DONE = object()
+
+
+def batches(items, size):
+    """ Yield lists of at most size items, reading the iterable only as far as needed """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def run_pipeline(source, stages, queue_size=QUEUE_SIZE):
+    """ Pass items through the chain of stages, each one running in its own threads
+
+    Stages are connected with bounded queues, so the memory stays flat however many items the source
+    produces, and the first item reaches the last stage without waiting for the source to finish.
+    Arguments:
+    source     -- iterable of items, consumed in a separate thread
+    stages     -- list of Stage: func is called with an item and returns the item for the next stage
+                  (None drops it), workers is the number of threads running the stage
+    queue_size -- maximum number of items waiting between two stages
+    Yields items returned by the last stage, in order of completion
+    """
+    queues = [queue.Queue(queue_size) for _ in range(len(stages) + 1)]
+
+    def produce():
+        try:
+            for item in source:
+                queues[0].put(item)
+        except Exception:
+            logger.exception('ERROR: Failed to produce pipeline items')
+        finally:
+            queues[0].put(_DONE)
+
+    def work(stage, input_queue, output_queue, remaining, lock):
+        while True:
+            item = input_queue.get()
+            if item is _DONE:
+                # Let the other workers of this stage know there's nothing more to do
+                input_queue.put(_DONE)
+                with lock:
+                    remaining[0] -= 1
+                    if remaining[0] == 0:
+                        output_queue.put(_DONE)
+                return
+            try:
+                item = stage.func(item)
+            except Exception:
+                logger.exception('ERROR: Pipeline stage failed')
+                continue
+            if item is not None:
+                output_queue.put(item)
+
+    threads = [threading.Thread(target=produce)]
+    for idx, stage in enumerate(stages):
+        workers = max(1, stage.workers)
+        remaining, lock = [workers], threading.Lock()
+        threads += [
+            threading.Thread(target=work, args=(stage, queues[idx], queues[idx + 1], remaining, lock))
+            for _ in range(workers)
+        ]
+    for thread in threads:
+        # Don't keep the process alive if the consumer stops early
+        thread.daemon = True
+        thread.start()
+
+    while True:
+        item = queues[-1].get()
+        if item is _DONE:
+            break
+        yield item
@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import tempfile
+
+import logging
+logger = logging.getLogger(__name__)
+
+__author__ = 'Denis Kovalev (aikikode)'
+
+
+def save_json(path, data):
+    """ Write data to the JSON file so that a crash never leaves it half-written
+    The data is written to a temporary file in the same directory first, which then replaces the target file
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.{}'.format(os.path.basename(path)))
+    try:
+        with os.fdopen(fd, 'w') as tmp_file:
+            json.dump(data, tmp_file)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import html
+from urllib.parse import urlparse, quote
+
+import lxml.etree as xml
+
+import logging
+logger = logging.getLogger(__name__)
+
+__author__ = 'Denis Kovalev (aikikode)'
+
+EXTENSIONS_NS = 'https://github.com/aikikode/tomboy2evernote'
+
+
+def quote_url(url):
+    """ Convert Tomboy link text to Evernote link address """
+    url = quote(url, safe="/;%[]=:$())+,!?*@'~")
+    if not urlparse(url).scheme:
+        url = 'http://{}'.format(url)
+    return url
+
+
+# Converts Tomboy note-content element to ENML, the same way TomboyConverter.innertext does.
+# Text is escaped with nested str:replace calls the same way html.escape does it. They are quite slow in libxslt,
+# so they're skipped for the text without special characters
+CONTENT_STYLESHEET = '''\
+<xsl:stylesheet version="1.0"
+    xmlns:xsl="http://www.w3.org/1999/XSL/Transform"
+    xmlns:str="http://exslt.org/strings"
+    xmlns:tomboy="http://beatniksoftware.com/tomboy"
+    xmlns:link="http://beatniksoftware.com/tomboy/link"
+    xmlns:size="http://beatniksoftware.com/tomboy/size"
+    xmlns:t2ev="{ns}"
+    extension-element-prefixes="str t2ev">
+  <xsl:output method="text" encoding="utf-8"/>
+
+  <xsl:template match="text()|comment()|processing-instruction()">
+    <xsl:choose>
+      <xsl:when test="translate(., concat('&amp;&lt;&gt;&quot;', &quot;'&quot;), '') = ."><xsl:value-of select="."/></xsl:when>
+      <xsl:otherwise><xsl:value-of select="str:replace(str:replace(str:replace(str:replace(str:replace(
+            ., '&amp;', '&amp;amp;'), '&lt;', '&amp;lt;'), '&gt;', '&amp;gt;'), '&quot;', '&amp;quot;'),
+            &quot;'&quot;, '&amp;#x27;')"/></xsl:otherwise>
+    </xsl:choose>
+  </xsl:template>
+
+  <!-- Content of a converted tag: its own text (the text before its first child) gets non-breaking spaces -->
+  <xsl:template name="content">
+    <xsl:apply-templates select="node()[1]" mode="own-text"/>
+    <xsl:apply-templates select="node()[position() > 1]"/>
+  </xsl:template>
+
+  <xsl:template match="text()" mode="own-text">
+    <xsl:choose>
+      <xsl:when test="translate(., concat('&amp;&lt;&gt;&quot;', &quot;'&quot;), '') = ."><xsl:value-of select="str:replace(., ' ', '&amp;nbsp;')"/></xsl:when>
+      <xsl:otherwise><xsl:value-of select="str:replace(str:replace(str:replace(str:replace(str:replace(str:replace(
+            ., '&amp;', '&amp;amp;'), '&lt;', '&amp;lt;'), '&gt;', '&amp;gt;'), '&quot;', '&amp;quot;'),
+            &quot;'&quot;, '&amp;#x27;'), ' ', '&amp;nbsp;')"/></xsl:otherwise>
+    </xsl:choose>
+  </xsl:template>
+
+  <xsl:template match="*|comment()|processing-instruction()" mode="own-text">
+    <xsl:apply-templates select="."/>
+  </xsl:template>
+
+  <xsl:template match="tomboy:bold">
+    <xsl:text>&lt;strong&gt;</xsl:text>
+    <xsl:call-template name="content"/>
+    <xsl:text>&lt;/strong&gt;</xsl:text>
+  </xsl:template>
+
+  <xsl:template match="tomboy:underline">
+    <xsl:text>&lt;span style="text-decoration: underline;"&gt;</xsl:text>
+    <xsl:call-template name="content"/>
+    <xsl:text>&lt;/span&gt;</xsl:text>
+  </xsl:template>
+
+  <xsl:template match="tomboy:monospace">
+    <xsl:text>&lt;span style="font-family: 'courier new', courier, monospace;"&gt;</xsl:text>
+    <xsl:call-template name="content"/>
+    <xsl:text>&lt;/span&gt;</xsl:text>
+  </xsl:template>
+
+  <xsl:template match="tomboy:list">
+    <xsl:text>&lt;ul&gt;</xsl:text>
+    <xsl:call-template name="content"/>
+    <xsl:text>&lt;/ul&gt;</xsl:text>
+  </xsl:template>
+
+  <xsl:template match="tomboy:list-item">
+    <xsl:text>&lt;li&gt;</xsl:text>
+    <xsl:call-template name="content"/>
+    <xsl:text>&lt;/li&gt;</xsl:text>
+  </xsl:template>
+
+  <xsl:template match="size:small">
+    <xsl:text>&lt;span style="font-size: 8pt;"&gt;</xsl:text>
+    <xsl:call-template name="content"/>
+    <xsl:text>&lt;/span&gt;</xsl:text>
+  </xsl:template>
+
+  <xsl:template match="size:large">
+    <xsl:text>&lt;span style="font-size: 14pt;"&gt;</xsl:text>
+    <xsl:call-template name="content"/>
+    <xsl:text>&lt;/span&gt;</xsl:text>
+  </xsl:template>
+
+  <xsl:template match="size:huge">
+    <xsl:text>&lt;span style="font-size: 18pt;"&gt;</xsl:text>
+    <xsl:call-template name="content"/>
+    <xsl:text>&lt;/span&gt;</xsl:text>
+  </xsl:template>
+
+  <!-- Links to local files are left as plain text -->
+  <xsl:template match="link:url[not(starts-with(node()[1][self::text()], '/'))]">
+    <xsl:variable name="href" select="t2ev:quote-url(string(node()[1][self::text()]))"/>
+    <xsl:text>&lt;a shape="rect" href="</xsl:text><xsl:value-of select="$href"/><xsl:text>"&gt;</xsl:text>
+    <xsl:value-of select="$href"/><xsl:text>&lt;/a&gt;</xsl:text>
+    <xsl:apply-templates select="node()[not(position() = 1 and self::text())]"/>
+  </xsl:template>
+
+  <!-- Unsupported tag - leave as plain text -->
+  <xsl:template match="*">
+    <xsl:apply-templates select="node()"/>
+  </xsl:template>
+</xsl:stylesheet>
+'''.format(ns=EXTENSIONS_NS)
+
+# Compiled once, lxml lets threads share it
+CONTENT_TRANSFORM = xml.XSLT(
+    xml.XML(CONTENT_STYLESHEET.encode('utf-8')),
+    extensions={(EXTENSIONS_NS, 'quote-url'): lambda context, url: quote_url(url)}
+)
+
+
+def transform_content(content_tag):
+    """ Convert Tomboy note-content element to ENML with CONTENT_TRANSFORM """
+    return '{}{}'.format(CONTENT_TRANSFORM(content_tag), html.escape(content_tag.tail or ''))
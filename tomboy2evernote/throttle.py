@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import http.client
+import random
+import socket
+import threading
+import time
+
+from evernote.edam.error.ttypes import EDAMSystemException, EDAMErrorCode
+from thrift.transport.TTransport import TTransportException
+
+import logging
+logger = logging.getLogger(__name__)
+
+__author__ = 'Denis Kovalev (aikikode)'
+
+# Additional number of seconds to wait after the rate limit duration reported by the service
+RATE_LIMIT_MARGIN = 2
+# Service errors that may go away if the call is repeated later
+RETRYABLE_ERRORS = (EDAMErrorCode.INTERNAL_ERROR, EDAMErrorCode.SHARD_UNAVAILABLE, EDAMErrorCode.RATE_LIMIT_REACHED, )
+# Network errors: socket errors and timeouts, broken HTTP responses, Thrift transport failures
+TRANSIENT_ERRORS = (OSError, http.client.HTTPException, TTransportException, )
+# Network errors raised before the request was sent, so the service could not have applied the call
+UNSENT_ERRORS = (ConnectionRefusedError, socket.gaierror, )
+
+
+class RateLimiter(object):
+    """ Token bucket shared by all threads calling Evernote API
+
+    Besides limiting the call rate it can pause all callers at once, e.g. when the service reports
+    that the rate limit is reached.
+    """
+    def __init__(self, rate=None, capacity=None):
+        """
+        Arguments:
+        rate     -- number of calls per second, None means no limit
+        capacity -- maximum number of calls that can be made in a burst
+        """
+        self.rate = rate
+        self.capacity = capacity or max(1, rate or 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def pause(self, seconds):
+        """ Block all callers for the given number of seconds """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def acquire(self):
+        """ Wait until the call is allowed """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.rate is None:
+                        return
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class RetryPolicy(object):
+    """ Decides which failed API calls should be repeated and how long to wait before that """
+    def __init__(self, attempts=5, backoff=1, max_backoff=60, jitter=0.5):
+        """
+        Arguments:
+        attempts    -- maximum number of attempts to make a call, including the first one
+        backoff     -- delay in seconds before the first retry, doubled for every next one
+        max_backoff -- maximum delay in seconds between two attempts
+        jitter      -- delays are randomly changed by up to this fraction, so that threads don't retry in sync
+        """
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+
+    @staticmethod
+    def is_rate_limit(ex):
+        return isinstance(ex, EDAMSystemException) and ex.errorCode == EDAMErrorCode.RATE_LIMIT_REACHED
+
+    @staticmethod
+    def is_timeout(ex):
+        return isinstance(ex, (TimeoutError, socket.timeout))
+
+    @staticmethod
+    def is_retryable(ex):
+        if isinstance(ex, EDAMSystemException):
+            return ex.errorCode in RETRYABLE_ERRORS
+        return isinstance(ex, TRANSIENT_ERRORS)
+
+    @staticmethod
+    def is_unsent(ex):
+        if isinstance(ex, TTransportException):
+            return ex.type == TTransportException.NOT_OPEN
+        return isinstance(ex, UNSENT_ERRORS)
+
+    def is_ambiguous(self, ex):
+        """ Whether the service may have applied the call despite the exception, e.g. the connection
+        was reset after the request was sent
+        """
+        return self.is_retryable(ex) and not self.is_rate_limit(ex) and not self.is_unsent(ex)
+
+    def retry_delay(self, ex, attempt, idempotent=True):
+        """ Return number of seconds to wait before repeating the call failed with the exception,
+        or None if the call should not be repeated
+        Arguments:
+        ex         -- exception raised by the call
+        attempt    -- number of the failed attempt, starting from 0
+        idempotent -- whether repeating an already applied call is harmless. Other calls, e.g. note creation,
+                      are repeated only if the service surely didn't apply them: on rate limit and on errors
+                      raised before the request was sent
+        """
+        if attempt + 1 >= self.attempts or not self.is_retryable(ex):
+            return None
+        if not idempotent and self.is_ambiguous(ex):
+            return None
+        if self.is_rate_limit(ex):
+            return (ex.rateLimitDuration or 0) + RATE_LIMIT_MARGIN
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+class CircuitBreaker(object):
+    """ Pauses all API callers at once when too many calls in a row have failed
+
+    This way a service outage makes every thread wait together instead of each one of them
+    spinning against the service with its own retries.
+    """
+    def __init__(self, rate_limiter, failure_threshold=10, break_duration=30):
+        """
+        Arguments:
+        rate_limiter      -- RateLimiter all callers go through
+        failure_threshold -- number of consecutive failed calls that opens the circuit
+        break_duration    -- number of seconds to pause all callers for
+        """
+        self.rate_limiter = rate_limiter
+        self.failure_threshold = failure_threshold
+        self.break_duration = break_duration
+        self.failures = 0
+        self.lock = threading.Lock()
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures < self.failure_threshold:
+                return
+            self.failures = 0
+        logger.error('ERROR: Too many failed requests, pausing for {} seconds'.format(self.break_duration))
+        self.rate_limiter.pause(self.break_duration)
+
+
+class ConcurrencyController(object):
+    """ Adjusts the number of simultaneous requests to the observed service behaviour (AIMD)
+
+    The limit grows by one after every `limit` fast successful requests and is halved when the service
+    reports rate limit or a request times out.
+    """
+    def __init__(self, initial=2, minimum=1, maximum=16, target_latency=2.0, cooldown=1.0):
+        """
+        Arguments:
+        initial        -- initial number of simultaneous requests
+        minimum        -- the limit never goes below this number
+        maximum        -- the limit never goes above this number
+        target_latency -- requests slower than this number of seconds don't let the limit grow
+        cooldown       -- minimum number of seconds between two decreases, so that a burst of failures
+                          of simultaneous requests cuts the limit only once
+        """
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.cooldown = cooldown
+        self.limit = max(minimum, min(maximum, initial))
+        self.in_flight = 0
+        self.successes = 0
+        self.decreased = 0
+        self.started = time.monotonic()
+        self.history = [(0.0, self.limit)]  # (seconds since start, limit) for every limit change
+        self.condition = threading.Condition()
+
+    def _set_limit(self, limit):
+        if limit != self.limit:
+            self.limit = limit
+            self.history.append((round(time.monotonic() - self.started, 3), limit))
+            self.condition.notify_all()
+
+    def acquire(self):
+        """ Wait until one more request is allowed """
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency=None):
+        """ Finish the request
+        Arguments:
+        latency -- request duration in seconds, None if the request failed
+        """
+        with self.condition:
+            self.in_flight -= 1
+            if latency is not None and latency <= self.target_latency:
+                self.successes += 1
+                if self.successes >= self.limit:
+                    self.successes = 0
+                    self._set_limit(min(self.maximum, self.limit + 1))
+            self.condition.notify()
+
+    def backoff(self):
+        """ Cut the limit in half after rate limit or timeout """
+        with self.condition:
+            now = time.monotonic()
+            if now - self.decreased < self.cooldown:
+                return
+            self.decreased = now
+            self.successes = 0
+            self._set_limit(max(self.minimum, self.limit // 2))
+
+    def __str__(self):
+        return '{} (history: {})'.format(self.limit, ' -> '.join('{}'.format(limit) for _, limit in self.history))
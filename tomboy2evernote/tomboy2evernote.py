@@ -1,74 +1,281 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
 import html
+import multiprocessing
+import os
+import re
+import threading
 import time
-from urllib.parse import urlparse, quote
 
-import isodate
 import lxml.etree as xml
 
 from evernote.api.client import EvernoteClient
-from evernote.edam.error.ttypes import EDAMUserException, EDAMSystemException, EDAMErrorCode
-from evernote.edam.limits.constants import EDAM_USER_NOTES_MAX
-from evernote.edam.notestore.ttypes import NoteFilter, NotesMetadataResultSpec
+from evernote.edam.error.ttypes import EDAMUserException, EDAMNotFoundException, EDAMErrorCode
+from evernote.edam.notestore.ttypes import NoteFilter, NotesMetadataResultSpec, SyncChunkFilter
 from evernote.edam.type.ttypes import Note, Notebook
 
+from tomboy2evernote.dates import parse_tomboy_date, tomboy_timestamp
+from tomboy2evernote.mirror import RemoteMirror
+from tomboy2evernote.stylesheet import quote_url, transform_content
+from tomboy2evernote.throttle import RateLimiter, RetryPolicy, CircuitBreaker
+
 import logging
 logger = logging.getLogger(__name__)
 
 __author__ = 'Denis Kovalev (aikikode)'
 
+# Maximum number of notes the service returns by a single findNotesMetadata call
+SEARCH_PAGE_SIZE = 250
+# Number of entries to request per sync chunk when building remote notes mirror
+SYNC_CHUNK_SIZE = 250
+# Note content conversion engines, see TomboyConverter
+ENGINES = ('python', 'xslt', )
+
+# Note metadata read without converting its content, see TomboyConverter.scan
+NoteHeader = namedtuple('NoteHeader', ['title', 'tags', 'notebook', 'created', 'updated', 'template'])
+
 
 class Evernote(EvernoteClient):
-    def __init__(self, token):
+    def __init__(self, token, index=None, note_store=None, search_page_size=SEARCH_PAGE_SIZE, rate_limiter=None,
+                 retry_policy=None, circuit_breaker=None, concurrency=None):
+        """
+        Arguments:
+        token            -- Evernote developer token
+        index            -- optional NoteIndex used to find already uploaded notes without remote searches
+        note_store       -- NoteStore client to use in all threads instead of requesting new ones from the service
+        search_page_size -- number of notes metadata to request per find_note search call
+        rate_limiter     -- RateLimiter shared by all API calls, by default calls are not limited
+        retry_policy     -- RetryPolicy for failed API calls
+        circuit_breaker  -- CircuitBreaker pausing all API calls after a burst of failures
+        concurrency      -- ConcurrencyController of the uploads, informed about rate limits and timeouts
+        """
         super(Evernote, self).__init__(dev_token=token, sandbox=False)
         self.token = token
+        self.index = index
+        self.search_page_size = search_page_size
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.circuit_breaker = circuit_breaker or CircuitBreaker(self.rate_limiter)
+        self.concurrency = concurrency
+        self.lock = threading.RLock()
+        # Held while notebooks are listed or created, so that every missing notebook is created once
+        self.notebooks_lock = threading.RLock()
+        self.mirror = None
+        self.mirror_synced = 0
+        self.mirror_lock = threading.RLock()
+        self.notebooks = None  # notebook name -> notebook guid cache
+        self.stats = Counter()  # number of notes 'created', 'updated', 'metadata_updated' and 'skipped'
+        self.shared_note_store = note_store
+        self.local = threading.local()
         try:
-            self.note_store = Evernote.call_method(self.get_note_store)
+            self.local.note_store = self.new_note_store()
         except EDAMUserException as ex:
             logger.error('ERROR: Authorization failed. Maybe your dev token expired?')
             raise ex
 
-    @staticmethod
-    def call_method(command, *args, **kwargs):
-        try:
-            result = command(*args, **kwargs)
-        except EDAMSystemException as ex:
-            if ex.errorCode == EDAMErrorCode.RATE_LIMIT_REACHED:
-                logger.error('ERROR: Upload rate too high, waiting for {} seconds'.format(ex.rateLimitDuration))
-                time.sleep(ex.rateLimitDuration + 2)
+    def new_note_store(self):
+        if self.shared_note_store is not None:
+            return self.shared_note_store
+        return self.call_method(self.get_note_store)
+
+    @property
+    def note_store(self):
+        """ NoteStore client of the current thread, each thread uses its own connection """
+        note_store = getattr(self.local, 'note_store', None)
+        if note_store is None:
+            note_store = self.local.note_store = self.new_note_store()
+        return note_store
+
+    def call_method(self, command, *args, idempotent=True, **kwargs):
+        """ Call Evernote API method, repeating it on rate limit and transient errors according to retry policy
+        Calls that must not be applied twice, like note creation, should set idempotent to False,
+        see RetryPolicy.retry_delay
+        """
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+            try:
                 result = command(*args, **kwargs)
+            except Exception as ex:
+                if self.concurrency is not None and (self.retry_policy.is_rate_limit(ex) or
+                                                     self.retry_policy.is_timeout(ex)):
+                    self.concurrency.backoff()
+                delay = self.retry_policy.retry_delay(ex, attempt, idempotent)
+                if delay is None:
+                    if self.retry_policy.is_retryable(ex):
+                        self.circuit_breaker.failure()
+                    raise ex
+                if self.retry_policy.is_rate_limit(ex):
+                    logger.error('ERROR: Upload rate too high, waiting for {} seconds'.format(ex.rateLimitDuration))
+                    # Stop all other threads too, they would hit the same limit
+                    self.rate_limiter.pause(delay)
+                else:
+                    logger.warning('Request failed: {}. Retrying in {:.1f} seconds'.format(ex, delay))
+                    self.circuit_breaker.failure()
+                    time.sleep(delay)
+                attempt += 1
             else:
-                raise ex
-        return result
+                self.circuit_breaker.success()
+                return result
+
+    def count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
 
-    def find_note(self, note_title):
-        notes_retrieve_count = EDAM_USER_NOTES_MAX
+    def prefetch(self, mirror=None):
+        """ Build in-memory mirror of all notes and notebooks metadata in the account
+        After that find_note does not make any remote searches.
+        Arguments:
+        mirror -- RemoteMirror loaded from previous run, only changes made after it are fetched
+        """
+        self.mirror = mirror if mirror is not None else RemoteMirror()
+        self.sync_mirror()
+        logger.info('Fetched {} notes metadata'.format(len(self.mirror)))
+
+    def sync_mirror(self, max_age=None):
+        """ Bring remote mirror up to date by fetching only chunks after the last seen update count
+        Arguments:
+        max_age -- don't check the service if the mirror was synced less than this number of seconds ago
+        """
+        if self.mirror is None:
+            return
+        # Threads asking at once wait for the first one instead of fetching the same chunks
+        with self.mirror_lock:
+            if max_age is not None and time.time() - self.mirror_synced < max_age:
+                return
+            mirror = self.mirror
+            state = self.call_method(self.note_store.getSyncState)
+            if state.fullSyncBefore and state.fullSyncBefore > mirror.server_time:
+                # Service requires clients that synced long ago to start over. The new mirror replaces
+                # the old one only when it's complete, other threads keep using the old one until then
+                mirror = RemoteMirror(mirror.path)
+            notebooks_changed = False
+            if state.updateCount > mirror.update_count:
+                sync_filter = SyncChunkFilter(includeNotes=True, includeNotebooks=True, includeExpunged=True)
+                while True:
+                    chunk = self.call_method(
+                        self.note_store.getFilteredSyncChunk, mirror.update_count, SYNC_CHUNK_SIZE, sync_filter
+                    )
+                    mirror.apply_chunk(chunk)
+                    notebooks_changed = notebooks_changed or bool(chunk.notebooks or chunk.expungedNotebooks)
+                    if chunk.chunkHighUSN is None or chunk.chunkHighUSN >= chunk.updateCount:
+                        mirror.update_count = chunk.updateCount
+                        break
+            mirror.server_time = state.currentTime or mirror.server_time
+            self.mirror = mirror
+            if notebooks_changed:
+                self.notebooks = None
+            self.mirror_synced = time.time()
+            mirror.save()
+
+    def get_notebook_guid(self, notebook_name):
+        """ Return guid of the notebook with provided name, create the notebook if there's no such one """
+        if not notebook_name:
+            return None
+        with self.notebooks_lock:
+            if self.notebooks is None:
+                if self.mirror is not None:
+                    self.notebooks = {name: guid for guid, name in self.mirror.notebooks.items()}
+                else:
+                    self.notebooks = {
+                        notebook.name: notebook.guid for notebook in self.call_method(self.note_store.listNotebooks)
+                    }
+            guid = self.notebooks.get(notebook_name)
+            if guid is None:
+                try:
+                    notebook = self.call_method(self.note_store.createNotebook, Notebook(name=notebook_name),
+                                                idempotent=False)
+                except Exception as ex:
+                    conflict = isinstance(ex, EDAMUserException) and ex.errorCode == EDAMErrorCode.DATA_CONFLICT
+                    if not conflict and not self.retry_policy.is_ambiguous(ex):
+                        raise ex
+                    # Notebook was created elsewhere after the cache was filled,
+                    # or by this very call if the connection failed before the response arrived
+                    self.notebooks = {
+                        notebook.name: notebook.guid for notebook in self.call_method(self.note_store.listNotebooks)
+                    }
+                    if notebook_name not in self.notebooks:
+                        raise ex
+                    return self.notebooks[notebook_name]
+                guid = self.notebooks[notebook_name] = notebook.guid
+                if self.mirror is not None:
+                    self.mirror.add_notebook(notebook)
+            return guid
+
+    def find_note(self, note_title, with_content=False):
+        """ Search for the note with exactly the provided title
+        Only note metadata (guid, title, USN and content length) is requested while searching,
+        full note with its content is downloaded only if with_content is set.
+        If remote mirror was prefetched, it is used instead of searching.
+        Returns NoteMetadata (RemoteNote if mirror is used) or Note (if with_content is set)
+        or None if nothing found
+        """
+        if self.mirror is not None:
+            note_data = self.mirror.find(note_title)
+            if note_data and with_content:
+                return self.call_method(self.note_store.getNote, note_data.guid, True, False, False, False)
+            return note_data
+        note_filter = NoteFilter(words='intitle:"{}"'.format(note_title))
+        result_spec = NotesMetadataResultSpec(includeTitle=True, includeUpdateSequenceNum=True,
+                                              includeContentLength=True)
         start_index = 0
-        remaining = notes_retrieve_count
-        notes = []
-        while remaining > 0:
-            notes_data_list = Evernote.call_method(
-                self.note_store.findNotesMetadata,
-                NoteFilter(words='intitle:"{}"'.format(note_title)),
-                start_index, notes_retrieve_count, NotesMetadataResultSpec()
+        while True:
+            notes_data_list = self.call_method(
+                self.note_store.findNotesMetadata, note_filter, start_index, self.search_page_size, result_spec
             )
-            retrieved_notes = [
-                Evernote.call_method(self.note_store.getNote, note_data.guid, True, False, False, False)
-                for note_data in notes_data_list.notes
-            ]
-            for n in retrieved_notes:
-                if n.title == note_title:
-                    return n
-            notes += retrieved_notes
-
-            total = notes_data_list.totalNotes
-            retrieved = len(notes)
-            start_index += retrieved
-            remaining = total - start_index
-        else:
+            for note_data in notes_data_list.notes:
+                if note_data.title == note_title:
+                    if with_content:
+                        return self.call_method(self.note_store.getNote, note_data.guid, True, False, False, False)
+                    return note_data
+            start_index += len(notes_data_list.notes)
+            if not notes_data_list.notes or start_index >= notes_data_list.totalNotes:
+                return None
+
+    def lookup_index(self, path=None, tomboy_guid=None, title=None):
+        """ Return Evernote GUID of the note stored in local index or None """
+        if self.index is None:
             return None
+        entry = self.index.lookup(path=path, tomboy_guid=tomboy_guid, title=title)
+        return entry.evernote_guid if entry else None
+
+    def forget_note(self, guid):
+        if self.index is not None:
+            self.index.forget(guid)
+        if self.mirror is not None:
+            self.mirror.remove_note(guid)
+
+    def remember_note(self, note, new_note):
+        if self.mirror is not None and note is not None and note.guid:
+            self.mirror.add_note(note)
+        if self.index is not None and note is not None and note.guid:
+            self.index.store(note.guid, note.updateSequenceNum, note.title,
+                             path=new_note.get('path'), tomboy_guid=new_note.get('guid'))
+
+    def update_note(self, guid, new_note, remote_note=None):
+        """ Update existing note
+        If remote note metadata with content hash is known (e.g. from prefetched mirror), unchanged content
+        is not uploaded at all and only created/updated times are sent if they differ.
+        Returns updated Note or remote_note if nothing had to be uploaded
+        """
+        note = Note(guid=guid, title=new_note.get('title'), content=new_note.get('content'),
+                    created=new_note.get('created'), updated=new_note.get('updated'))
+        if getattr(remote_note, 'contentHash', None) is not None and note.content is not None:
+            content = note.content.encode('utf-8')
+            if len(content) == remote_note.contentLength and hashlib.md5(content).digest() == remote_note.contentHash:
+                if (note.title, note.created, note.updated) == \
+                        (remote_note.title, remote_note.created, remote_note.updated):
+                    self.count('skipped')
+                    return remote_note
+                note.content = None
+                self.count('metadata_updated')
+                return self.call_method(self.note_store.updateNote, note)
+        self.count('updated')
+        return self.call_method(self.note_store.updateNote, note)
 
     def create_or_update_note(self, new_note):
         """ Create new note or update existing one if there's any with provided tile
@@ -79,136 +286,402 @@ class Evernote(EvernoteClient):
           'notebook' -- name of the notebook to create note in (ignored on 'update')
           'created'  -- note creation time in milliseconds from epoch
           'updated'  -- note last updated time in milliseconds from epoch
+          'path'     -- (optional) Tomboy note file path, used as local index key
+          'guid'     -- (optional) Tomboy note GUID, used as local index key
+        Returns uploaded note metadata
         """
         note_title = new_note.get('title')
-        note_contents = new_note.get('content')
-        notebook_name = new_note.get('notebook')
-        note_created = new_note.get('created')
-        note_updated = new_note.get('updated')
-        note = self.find_note(note_title)
-        if note:
-            note.content = note_contents
-            note.created = note_created
-            note.updated = note_updated
-            Evernote.call_method(self.note_store.updateNote, note)
+        guid = self.lookup_index(path=new_note.get('path'), tomboy_guid=new_note.get('guid'), title=note_title)
+        if guid and self.mirror is not None and guid not in self.mirror.notes:
+            # Note was deleted from Evernote since the last upload
+            self.forget_note(guid)
+            guid = None
+        if guid:
+            # Note was uploaded before - update it in place without searching
+            try:
+                note = self.update_note(guid, new_note, self.mirror.notes[guid] if self.mirror is not None else None)
+            except EDAMNotFoundException:
+                # Note was expunged from Evernote since the last upload
+                self.forget_note(guid)
+            else:
+                if getattr(note, 'active', None) is not False:
+                    self.remember_note(note, new_note)
+                    return note
+                # Note was moved to trash since the last upload, it stays there and the note is created again
+                # the way it is done for notes not uploaded before
+                self.forget_note(guid)
+        note_data = self.find_note(note_title)
+        if note_data:
+            note = self.update_note(note_data.guid, new_note, note_data)
         else:
             note = Note()
-            note.title, note.content = note_title, note_contents
-            note.created, note.updated = note_created, note_updated
-            for notebook in Evernote.call_method(self.note_store.listNotebooks):
-                if notebook.name == notebook_name:
-                    note.notebookGuid = notebook.guid
-                    break
-            else:
-                if notebook_name:
-                    # Notebook not found, create new one
-                    notebook = Notebook()
-                    notebook.name = notebook_name
-                    notebook = Evernote.call_method(self.note_store.createNotebook, notebook)
-                    note.notebookGuid = notebook.guid
-            Evernote.call_method(self.note_store.createNote, note)
+            note.title, note.content = note_title, new_note.get('content')
+            note.created, note.updated = new_note.get('created'), new_note.get('updated')
+            note.notebookGuid = self.get_notebook_guid(new_note.get('notebook'))
+            try:
+                note = self.call_method(self.note_store.createNote, note, idempotent=False)
+            except Exception as ex:
+                if not self.retry_policy.is_ambiguous(ex):
+                    raise ex
+                # Creating the note again could make a duplicate, look for it instead
+                note = self.find_created_note(note_title)
+                if note is None:
+                    raise ex
+            self.count('created')
+        self.remember_note(note, new_note)
+        return note
+
+    def find_created_note(self, note_title):
+        """ Return metadata of the note the service may have created although createNote call failed,
+        e.g. because the connection broke before the response arrived, or None if it's not found
+        """
+        try:
+            if self.mirror is not None:
+                self.sync_mirror()
+            return self.find_note(note_title)
+        except Exception as ex:
+            logger.warning('Failed to check whether note \'{}\' was created: {}'.format(note_title, ex))
+            return None
 
     def cat_note(self, note_title):
-        note = self.find_note(note_title)
+        note = None
+        guid = self.lookup_index(title=note_title)
+        if guid:
+            try:
+                note = self.call_method(self.note_store.getNote, guid, True, False, False, False)
+            except EDAMNotFoundException:
+                self.forget_note(guid)
+        if not note:
+            note = self.find_note(note_title, with_content=True)
         if note:
             print(note.content)
 
     def remove_note(self, note_title):
+        guid = self.lookup_index(title=note_title)
+        if guid:
+            self.forget_note(guid)
+            try:
+                self.call_method(self.note_store.deleteNote, guid, idempotent=False)
+                return
+            except EDAMNotFoundException:
+                pass
         note = self.find_note(note_title)
         if note:
-            Evernote.call_method(self.note_store.deleteNote, note.guid)
-
-
-def convert_tomboy_to_evernote(note_path):
-    def el(name, parent=''):
-        return '{{http://beatniksoftware.com/tomboy{}}}{}'.format(parent, name)
-
-    tags_convertion = {
-        el('bold'): 'strong',
-        el('underline'): ['span style="text-decoration: underline;"', 'span', ],
-        el('monospace'): ['span style="font-family: \'courier new\', courier, monospace;"', 'span', ],
-        el('list'): 'ul',
-        el('list-item'): 'li',
-        el('small', '/size'): ['span style="font-size: 8pt;"', 'span', ],
-        el('large', '/size'): ['span style="font-size: 14pt;"', 'span', ],
-        el('huge', '/size'): ['span style="font-size: 18pt;"', 'span', ],
-    }
-
-    def innertext(tag):
-        """Convert Tomboy XML to Markdown"""
-        text = tag.text or ''
-        tail_text = html.escape('{}'.format(tag.tail or ''))
-        try:
-            if tag.tag == el('url', '/link') and not text.startswith('/'):
-                text = quote(text, safe="/;%[]=:$())+,!?*@'~")
-                if not urlparse(text).scheme:
-                    text = 'http://{}'.format(text)
-                ev_tag = ('a shape="rect" href="{}"'.format(text), 'a')
-                text = '<{}>{}</{}>'.format(ev_tag[0], text, ev_tag[1])
-            else:
-                text = html.escape(text or '')
-                ev_tag = tags_convertion[tag.tag]
-                if isinstance(ev_tag, list):
-                    start_tag, end_tag = ev_tag
-                else:
-                    start_tag = end_tag = ev_tag
-                text = '<{}>{}'.format(start_tag, text.replace(' ', '&nbsp;'))
-                tail_text = '</{}>{}'.format(end_tag, tail_text)
-        except KeyError:
-            # Unsupported tag - leave as plain text
-            pass
-        return '{}{}{}'.format(text, ''.join(innertext(e) for e in tag), tail_text)
-
-    tomboy_cat_prefix = 'system:notebook:'
-    root = xml.parse(note_path).getroot()
-
-    tags = []
-    notebook = None
-
-    tagsEl = root.find(el('tags'))
-    if tagsEl is not None:
-        for tagEl in tagsEl:
-            tag = tagEl.text
-            if tag.startswith(tomboy_cat_prefix):
-                notebook = tag.replace(tomboy_cat_prefix, '')
-            else:
-                tags.append(tag)
-    if 'system:template' in tags:
-        return None
-
-    note = {}
-
-    title = root.find(el('title')).text
-    # Empty title should be replaced with note creation date
-    created = '{}'.format(isodate.parse_datetime(root.find(el('create-date')).text))
-    if not title:  # title is empty
-        title = created
-    title = title.lstrip()
-    if not title:  # it consisted only of spaces, which is illegal
-        title = created
-
-    # Parse and convert contents to evernote format
-    evernote_header = (
+            self.call_method(self.note_store.deleteNote, note.guid, idempotent=False)
+            self.forget_note(note.guid)
+
+
+class TomboyConverter(object):
+    """ Converts Tomboy notes to Evernote note dictionaries, see Evernote.create_or_update_note
+
+    Tag names, conversion tables and the XML parser are set up once per converter instead of once per note,
+    so bulk and daemon uploads should reuse a single converter. It can be shared between threads:
+    each thread gets its own parser.
+    """
+    NS = 'http://beatniksoftware.com/tomboy'
+    NOTEBOOK_PREFIX = 'system:notebook:'
+    TEMPLATE_TAG = 'system:template'
+    TEXT_START = re.compile(rb'<text[\s>]')
+    TEXT_END = b'</text>'
+    ENML_HEADER = (
         "<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n"
         "<!DOCTYPE en-note SYSTEM \"http://xml.evernote.com/pub/enml2.dtd\">\n"
     )
-    content_tag = root.find(el('text')).find(el('note-content'))
-    content = innertext(content_tag).replace(title, '', 1).lstrip()
-    content = '{}<en-note>{}</en-note>'.format(
-        evernote_header, ''.join([
-            '{}<br clear="none"/>'.format(line.strip())
-            if not line.strip().endswith('</ul>')
-            else '{}'.format(line.strip())
-            for line in content.split('\n')
-        ])
-    )
 
-    for tag, key in [('create-date', 'created'), ('last-change-date', 'updated'), ]:
-        # store time as milliseconds (https://dev.evernote.com/doc/reference/Types.html#Typedef_Timestamp)
-        note[key] = int(time.mktime(isodate.parse_datetime(root.find(el(tag)).text).timetuple())) * 1000
+    def __init__(self, engine='python', huge_tree=False):
+        """
+        Arguments:
+        engine    -- how to convert note content: 'python' or 'xslt' (see tomboy2evernote.stylesheet),
+                     the result is the same
+        huge_tree -- allow very large and very deeply nested notes, which the parser rejects by default
+                     to protect from malicious documents
+        """
+        self.engine = engine
+        self.huge_tree = huge_tree
+        self.local = threading.local()
+
+        def el(name, parent=''):
+            return '{{{}{}}}{}'.format(TomboyConverter.NS, parent, name)
+
+        self.tags_tag = el('tags')
+        self.title_tag = el('title')
+        self.text_tag = el('text')
+        self.content_tag = el('note-content')
+        self.created_tag = el('create-date')
+        self.updated_tag = el('last-change-date')
+        self.url_tag = el('url', '/link')
+        # Tomboy tag -> (ENML opening tag, ENML closing tag)
+        self.tags_convertion = {
+            el(name, parent): ('<{}>'.format(start_tag), '</{}>'.format(end_tag))
+            for name, parent, start_tag, end_tag in [
+                ('bold', '', 'strong', 'strong'),
+                ('underline', '', 'span style="text-decoration: underline;"', 'span'),
+                ('monospace', '', 'span style="font-family: \'courier new\', courier, monospace;"', 'span'),
+                ('list', '', 'ul', 'ul'),
+                ('list-item', '', 'li', 'li'),
+                ('small', '/size', 'span style="font-size: 8pt;"', 'span'),
+                ('large', '/size', 'span style="font-size: 14pt;"', 'span'),
+                ('huge', '/size', 'span style="font-size: 18pt;"', 'span'),
+            ]
+        }
+
+    def __getstate__(self):
+        # Parsers can't be pickled, e.g. to send the converter to another process
+        return {'engine': self.engine, 'huge_tree': self.huge_tree}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @property
+    def parser(self):
+        parser = getattr(self.local, 'parser', None)
+        if parser is None:
+            # Notes don't need DTD or external entities, so none are loaded
+            parser = self.local.parser = xml.XMLParser(
+                resolve_entities=False, no_network=True, load_dtd=False, huge_tree=self.huge_tree
+            )
+        return parser
+
+    def parse(self, note_path):
+        return xml.parse(note_path, self.parser).getroot()
+
+    def convert(self, note_path, root=None):
+        """ Convert Tomboy note file
+        Arguments:
+        note_path -- Tomboy note file path
+        root      -- root element of the already parsed note, the file is parsed if it's not provided
+        Returns None for template notes
+        """
+        if root is None:
+            root = self.parse(note_path)
+        return self.convert_root(root, note_path)
+
+    def convert_bytes(self, data, note_path=None):
+        """ Convert Tomboy note contents
+        Arguments:
+        data      -- note XML
+        note_path -- Tomboy note file path, if there's any
+        Returns None for template notes
+        """
+        return self.convert_root(xml.fromstring(data, self.parser), note_path)
+
+    def innertext(self, tag):
+        """ Convert Tomboy XML to ENML
+        The tree is walked with an explicit stack instead of recursion, so that deeply nested lists
+        don't hit the recursion limit, and all the fragments are joined once at the end
+        """
+        fragments = []
+        stack = [tag]
+        while stack:
+            tag = stack.pop()
+            if isinstance(tag, str):
+                # Closing tag and tail text of the element whose children are already converted
+                fragments.append(tag)
+                continue
+            text = tag.text or ''
+            tail_text = html.escape(tag.tail or '')
+            if tag.tag == self.url_tag and not text.startswith('/'):
+                text = quote_url(text)
+                fragments.append('<a shape="rect" href="{}">{}</a>'.format(text, text))
+            else:
+                text = html.escape(text)
+                ev_tag = self.tags_convertion.get(tag.tag)
+                if ev_tag is None:
+                    # Unsupported tag - leave as plain text
+                    fragments.append(text)
+                else:
+                    fragments.append(ev_tag[0] + text.replace(' ', '&nbsp;'))
+                    tail_text = ev_tag[1] + tail_text
+            stack.append(tail_text)
+            stack.extend(reversed(tag))
+        return ''.join(fragments)
+
+    @staticmethod
+    def split_tags(tags_element):
+        """ Return tuple of (list of note tags, notebook name or None) from Tomboy tags element """
+        tags = []
+        notebook = None
+        if tags_element is not None:
+            for tagEl in tags_element:
+                tag = tagEl.text
+                if tag.startswith(TomboyConverter.NOTEBOOK_PREFIX):
+                    notebook = tag.replace(TomboyConverter.NOTEBOOK_PREFIX, '')
+                else:
+                    tags.append(tag)
+        return tags, notebook
+
+    @staticmethod
+    def note_title(title, created):
+        """ Return Evernote title of the note with the given Tomboy title and creation date """
+        # Empty title should be replaced with note creation date
+        if not title:  # title is empty
+            title = '{}'.format(parse_tomboy_date(created))
+        title = title.lstrip()
+        if not title:  # it consisted only of spaces, which is illegal
+            title = '{}'.format(parse_tomboy_date(created))
+        return title
+
+    def scan(self, note_path):
+        """ Read note header: title, tags and dates, without parsing the content
+        Note content is escaped, so the text element tags can't appear inside it and the whole element is cut out
+        of the file before it goes to the incremental parser. Notes written differently are parsed in full.
+        Returns NoteHeader
+        """
+        with open(note_path, 'rb') as note_file:
+            data = note_file.read()
+        parser = xml.XMLPullParser(
+            events=('end', ), tag=(self.title_tag, self.created_tag, self.updated_tag, self.tags_tag, ),
+            resolve_entities=False, no_network=True, load_dtd=False, huge_tree=self.huge_tree
+        )
+        start = TomboyConverter.TEXT_START.search(data)
+        end = data.rfind(TomboyConverter.TEXT_END)
+        if start is not None and end > start.start():
+            parser.feed(data[:start.start()])
+            parser.feed(data[end + len(TomboyConverter.TEXT_END):])
+        else:
+            parser.feed(data)
+        parser.close()
+        values = {}
+        tags_element = None
+        for _, element in parser.read_events():
+            if element.tag == self.tags_tag:
+                tags_element = element
+            else:
+                values[element.tag] = element.text
+        tags, notebook = self.split_tags(tags_element)
+        created = values.get(self.created_tag)
+        updated = values.get(self.updated_tag)
+        return NoteHeader(
+            title=self.note_title(values.get(self.title_tag), created), tags=tags, notebook=notebook,
+            created=tomboy_timestamp(created) if created else None,
+            updated=tomboy_timestamp(updated) if updated else None,
+            template=TomboyConverter.TEMPLATE_TAG in tags
+        )
+
+    def convert_root(self, root, note_path=None):
+        tags, notebook = self.split_tags(root.find(self.tags_tag))
+        if TomboyConverter.TEMPLATE_TAG in tags:
+            return None
+
+        note = {}
+
+        created = root.find(self.created_tag).text
+        title = self.note_title(root.find(self.title_tag).text, created)
+
+        # Parse and convert contents to evernote format
+        content_tag = root.find(self.text_tag).find(self.content_tag)
+        content = transform_content(content_tag) if self.engine == 'xslt' else self.innertext(content_tag)
+        content = content.replace(title, '', 1).lstrip()
+        content = '{}<en-note>{}</en-note>'.format(
+            TomboyConverter.ENML_HEADER, ''.join([
+                '{}<br clear="none"/>'.format(line.strip())
+                if not line.strip().endswith('</ul>')
+                else '{}'.format(line.strip())
+                for line in content.split('\n')
+            ])
+        )
+
+        note['created'] = tomboy_timestamp(created)
+        note['updated'] = tomboy_timestamp(root.find(self.updated_tag).text)
+        note['title'] = title
+        note['content'] = content
+        note['tags'] = tags
+        note['notebook'] = notebook
+        note['path'] = note_path
+        note['guid'] = os.path.splitext(os.path.basename(note_path))[0] if note_path else None
+        return note
+
+
+class NoteSelector(object):
+    """ Decides which notes to upload by their NoteHeader, so that unwanted notes are not parsed in full """
+    def __init__(self, notebook=None, tags=None, title_regex=None):
+        """
+        Arguments:
+        notebook    -- select only notes from this notebook
+        tags        -- select only notes with any of these tags
+        title_regex -- select only notes whose title matches this regular expression (string or compiled)
+        Template notes are never selected
+        """
+        self.notebook = notebook
+        self.tags = set(tags or [])
+        self.title_regex = re.compile(title_regex) if title_regex is not None else None
+
+    def matches(self, header):
+        if header.template:
+            return False
+        if self.notebook is not None and header.notebook != self.notebook:
+            return False
+        if self.tags and self.tags.isdisjoint(header.tags):
+            return False
+        return self.title_regex is None or self.title_regex.search(header.title) is not None
+
+
+# Default converter for every engine
+CONVERTERS = {engine: TomboyConverter(engine) for engine in ENGINES}
+
+
+def convert_tomboy_to_evernote(note_path, root=None, engine='python'):
+    """ Convert Tomboy note to Evernote note dictionary with the default converter, see TomboyConverter
+    Arguments:
+    note_path -- Tomboy note file path
+    root      -- root element of the already parsed note, the file is parsed if it's not provided
+    engine    -- how to convert note content: 'python' or 'xslt' (see tomboy2evernote.stylesheet)
+    Returns None for template notes
+    """
+    return CONVERTERS[engine].convert(note_path, root)
+
+
+# Converter of the current conversion worker process, see new_process_pool
+_process_converter = None
+
+
+def _init_process(converter):
+    global _process_converter
+    _process_converter = converter
+
+
+def convert_note(tomboy_note, converter=None):
+    """ Convert Tomboy note catching any error, so that the failure can be reported after bulk conversion
+    Arguments:
+    tomboy_note -- Tomboy note file path
+    converter   -- TomboyConverter, the process pool one or the default one if it's not set
+    Returns tuple of (converted note or None, error message or None)
+    """
+    try:
+        return (converter or _process_converter or CONVERTERS['python']).convert(tomboy_note), None
+    except Exception as ex:
+        return None, '{}'.format(ex)
+
+
+def new_process_pool(jobs, converter=None):
+    """ Return ProcessPoolExecutor for note conversion
+    The converter is sent to every worker process once, when it starts, so only notes paths are sent
+    with the notes. Worker processes are started by a fork server, not forked from the caller, which may be
+    running other threads at the time.
+    Arguments:
+    jobs      -- number of processes
+    converter -- TomboyConverter to convert notes with, the default one if it's not set
+    """
+    start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context(start_method),
+                               initializer=_init_process, initargs=(converter, ))
+
 
-    note['title'] = title
-    note['content'] = content
-    note['tags'] = tags
-    note['notebook'] = notebook
-    return note
+def convert_notes(notes_files, jobs=1, converter=None, executor=None):
+    """ Convert Tomboy notes using the given number of processes
+    Arguments:
+    notes_files -- list of Tomboy notes files paths
+    jobs        -- number of processes to convert notes with
+    converter   -- TomboyConverter, the default one if it's not set
+    executor    -- process pool to use, see new_process_pool. Its processes use the converter the pool
+                   was created with. A new pool is started and shut down if it's not set
+    Returns list of convert_note results in the same order as notes_files
+    """
+    if jobs <= 1 or len(notes_files) <= 1:
+        return [convert_note(tomboy_note, converter) for tomboy_note in notes_files]
+    if executor is None:
+        with new_process_pool(jobs, converter) as executor:
+            return convert_notes(notes_files, jobs, converter, executor)
+    # Send notes to worker processes in chunks to reduce inter-process communication overhead
+    chunk_size = max(1, min(64, len(notes_files) // (jobs * 4)))
+    return list(executor.map(convert_note, notes_files, chunksize=chunk_size))
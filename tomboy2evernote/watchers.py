@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import time
+
+import pyinotify
+
+from tomboy2evernote.daemon import daemonize
+
+import logging
+logger = logging.getLogger(__name__)
+
+__author__ = 'Denis Kovalev (aikikode)'
+
+# Polling interval bounds in seconds
+POLL_MIN_INTERVAL = 1
+POLL_MAX_INTERVAL = 5
+# Maximum share of CPU time the polling watcher may spend on scanning
+POLL_CPU_SHARE = 0.01
+
+# Watchers report changes in the Tomboy notes directory to NotesDaemon (see tomboy2evernote.daemon):
+# run(daemon, pid_file, stdout) starts watching, daemonizes the process and then calls daemon.changed(path),
+# daemon.moved(src_path, dst_path) and daemon.overflowed() for the changes and daemon.flush() at least every
+# daemon.tick seconds. It never returns.
+
+
+class InotifyWatcher(object):
+    """ Receives changes from the kernel with inotify """
+    # Notes are written through temporary files and renames, so there's no need to look at every write:
+    # a note is complete when its file is closed or moved into place
+    MASK = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_DELETE | pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM
+
+    class EventHandler(pyinotify.ProcessEvent):
+        def my_init(self, daemon):
+            self.daemon = daemon
+
+        def process_default(self, event):
+            self.daemon.changed(event.pathname)
+
+        def process_IN_MOVED_TO(self, event):
+            # pyinotify pairs the move with the preceding IN_MOVED_FROM by cookie and sets src_pathname
+            src_path = getattr(event, 'src_pathname', None)
+            if src_path:
+                self.daemon.moved(src_path, event.pathname)
+            else:
+                self.daemon.changed(event.pathname)
+
+        def process_IN_Q_OVERFLOW(self, event):
+            self.daemon.overflowed()
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def run(self, daemon, pid_file, stdout):
+        wm = pyinotify.WatchManager()
+        # Wake up regularly even without events to upload notes whose quiet period is over
+        notifier = pyinotify.Notifier(wm, InotifyWatcher.EventHandler(daemon=daemon),
+                                      timeout=int(daemon.tick * 1000))
+        # Watch is set up before anything else, so no change is missed
+        wm.add_watch(self.directory, InotifyWatcher.MASK, rec=False)
+        daemonize(pid_file, stdout)
+        notifier.loop(callback=lambda notifier: daemon.flush())
+
+
+class PollingWatcher(object):
+    """ Finds changes by comparing directory listings, for filesystems where inotify gets no events (NFS, sshfs)
+
+    Only size, modification time and inode of every note are kept between the scans. The scans are spaced
+    so that they take less than POLL_CPU_SHARE of CPU time: the interval grows while nothing changes and drops
+    back right after a change.
+    """
+    def __init__(self, directory, min_interval=POLL_MIN_INTERVAL, max_interval=POLL_MAX_INTERVAL):
+        self.directory = directory
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.files = {}  # note file name -> (size, mtime_ns, inode)
+
+    def listing(self):
+        files = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files[entry.name] = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        return files
+
+    def scan(self, daemon):
+        """ Report the changes since the previous scan to the daemon. Returns True if there were any """
+        files = self.listing()
+        added = {name: signature for name, signature in files.items() if self.files.get(name) != signature}
+        removed = {name: signature for name, signature in self.files.items() if name not in files}
+        # File that disappeared and a new one with the same inode and contents is a rename
+        inodes = {signature: name for name, signature in removed.items()}
+        for name, signature in added.items():
+            src_name = inodes.pop(signature, None) if name not in self.files else None
+            if src_name is not None:
+                daemon.moved(os.path.join(self.directory, src_name), os.path.join(self.directory, name))
+            else:
+                daemon.changed(os.path.join(self.directory, name))
+        for name in inodes.values():
+            daemon.changed(os.path.join(self.directory, name))
+        self.files = files
+        return bool(added or removed)
+
+    def adjust_interval(self, cpu_time, changed):
+        floor = max(self.min_interval, cpu_time / POLL_CPU_SHARE)
+        if changed:
+            self.interval = floor
+        else:
+            self.interval = max(floor, min(self.max_interval, self.interval * 1.5))
+
+    def run(self, daemon, pid_file, stdout):
+        self.files = self.listing()
+        daemonize(pid_file, stdout)
+        next_scan = 0
+        while True:
+            now = time.monotonic()
+            if now >= next_scan:
+                started = time.thread_time()
+                try:
+                    changed = self.scan(daemon)
+                except OSError as ex:
+                    logger.error('ERROR: Failed to scan Tomboy notes: {}'.format(ex))
+                    changed = False
+                self.adjust_interval(time.thread_time() - started, changed)
+                next_scan = now + self.interval
+            daemon.flush()
+            time.sleep(min(daemon.tick, max(0, next_scan - time.monotonic())))
+
+
+WATCHERS = {
+    'inotify': InotifyWatcher,
+    'poll': PollingWatcher,
+}